@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+""" Run the Cameo pipeline over video files and images, without a display
+
+Usage: python batch.py 'footage/*.avi' snapshots/*.png --output-dir out
+           [--curve provia] [--swap-faces [--blend-faces]] [--debug-rects]
+           [--no-stroke-edges] [--motion-gate] [--workers 4] [--overwrite]
+
+Raw frame stores (.frames files, as recorded by Cameo) are read like videos
+and written as .avi files. The outputs keep the inputs' paths relative to
+the directory they have in common, so files of the same name in different
+directories don't overwrite each other. No output may be one of the inputs,
+and outputs that already exist are skipped unless --overwrite is given.
+
+Files are processed concurrently, one per worker process. Each worker
+reports its progress and each finished file its throughput.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import filters
+import framestore
+from motion import MotionGate, TiledFilterCache
+import rects
+from trackers import FaceTracker
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.avi', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg',
+                    '.webm', '.wmv', framestore.FILE_EXTENSION)
+
+CURVE_FILTERS = {
+    'crossprocess': filters.BGRCrossProcessCurveFilter,
+    'portra': filters.BGRPortraCurveFilter,
+    'provia': filters.BGRProviaCurveFilter,
+    'velvia': filters.BGRVelviaCurveFilter}
+
+
+class FramePipeline(object):
+    """ The per-frame work of Cameo.run: face swap, filters and debug rects """
+
+    def __init__(self, shouldSwapFaces=False, shouldStrokeEdges=True,
+            curveName='provia', shouldDrawDebugRects=False,
+            shouldBlendFaces=False, shouldGateMotion=False):
+        self.shouldSwapFaces = shouldSwapFaces
+        self.shouldBlendFaces = shouldBlendFaces
+        self.shouldGateMotion = shouldGateMotion
+        self.shouldDrawDebugRects = shouldDrawDebugRects
+
+        self._faceTracker = None
+        if shouldSwapFaces or shouldDrawDebugRects:
+            self._faceTracker = FaceTracker()
+
+        filterList = []
+        if shouldStrokeEdges:
+            filterList.append(filters.StrokeEdgesFilter())
+        if curveName is not None:
+            filterList.append(CURVE_FILTERS[curveName]())
+        self._filterChain = filters.FilterChain(filterList)
+
+        self._motionGate = MotionGate()
+        self._filterCache = TiledFilterCache(self._filterChain)
+        self._previousFaceRects = []
+
+    @property
+    def faceTracker(self):
+        return self._faceTracker
+
+    def apply(self, frame):
+        """ Process a BGR frame in place """
+        if self.shouldGateMotion:
+            self._motionGate.update(frame)
+        isStatic = self.shouldGateMotion and self._motionGate.isStatic
+        if self._faceTracker is not None and not isStatic:
+            self._faceTracker.update(frame)
+        faceRects = []
+        if self.shouldSwapFaces:
+            faceRects = [face.faceRect for face in self._faceTracker.faces]
+            rects.swapRects(frame, frame, faceRects,
+                            shouldBlend=self.shouldBlendFaces)
+
+        if self.shouldGateMotion:
+            self._filterCache.apply(frame, frame,
+                self._motionGate.dirtyRects + faceRects +
+                self._previousFaceRects)
+        else:
+            self._filterChain.apply(frame, frame)
+        self._previousFaceRects = faceRects
+
+        if self.shouldDrawDebugRects:
+            self._faceTracker.drawDebugRects(frame)
+
+
+def expandInputs(patterns):
+    """ Return the sorted files matching any of the patterns
+
+    A directory stands for the image and video files anywhere inside it.
+    """
+    filenames = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and os.path.exists(pattern):
+            matches = [pattern]
+        for match in matches:
+            if os.path.isfile(match):
+                filenames.add(match)
+            elif os.path.isdir(match):
+                for dirpath, _, dirFilenames in os.walk(match):
+                    filenames.update(
+                        os.path.join(dirpath, filename)
+                        for filename in dirFilenames
+                        if isImageFile(filename) or isVideoFile(filename))
+    return sorted(filenames)
+
+def isImageFile(filename):
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+def isVideoFile(filename):
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+def createOutputFilenames(filenames, outputDir):
+    """ Return each file's output path, relative to the inputs' common
+    directory; raise ValueError if two files would have the same output or
+    an output would be one of the inputs """
+    if not filenames:
+        return []
+    inputDir = os.path.commonpath(
+        [os.path.dirname(os.path.abspath(filename)) for filename in filenames])
+    inputKeys = set(_pathKey(filename) for filename in filenames)
+    outputFilenames = []
+    inputsByOutput = {}
+    for filename in filenames:
+        outputFilename = os.path.join(
+            outputDir, os.path.relpath(os.path.abspath(filename), inputDir))
+        if framestore.isFrameStore(filename):
+            # Raw frame stores are replayed, but the output is encoded
+            outputFilename = os.path.splitext(outputFilename)[0] + '.avi'
+        key = _pathKey(outputFilename)
+        if key in inputKeys:
+            raise ValueError('{} would overwrite the input {}'.format(
+                filename, outputFilename))
+        if key in inputsByOutput:
+            raise ValueError('{} and {} would both be written to {}'.format(
+                inputsByOutput[key], filename, outputFilename))
+        inputsByOutput[key] = filename
+        outputFilenames.append(outputFilename)
+    return outputFilenames
+
+def _pathKey(filename):
+    """ The file's path with symbolic links resolved, for comparisons """
+    return os.path.normcase(os.path.realpath(filename))
+
+def processFile(task):
+    """ Process one file; return (filename, frames, seconds, bytes read) """
+    (filename, outputFilename, pipelineOptions, fourcc,
+     progressInterval) = task
+    pipeline = FramePipeline(**pipelineOptions)
+    startTime = time.time()
+
+    if isImageFile(filename):
+        frame = cv2.imread(filename)
+        if frame is None:
+            print("[BATCH] Could not read", filename)
+            return filename, 0, 0.0, 0
+        pipeline.apply(frame)
+        if not cv2.imwrite(outputFilename, frame):
+            print("[BATCH] Could not write", outputFilename)
+            return filename, 0, time.time() - startTime, 0
+        return (filename, 1, time.time() - startTime,
+                os.path.getsize(filename))
+
+    capture = framestore.openCapture(filename)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if fps <= 0.0:
+        fps = 30.0
+    totalFrames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    videoWriter = None
+
+    numFrames = 0
+    success, frame = capture.read()
+    while success:
+        if videoWriter is None:
+            size = (frame.shape[1], frame.shape[0])
+            videoWriter = cv2.VideoWriter(
+                outputFilename, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+            if not videoWriter.isOpened():
+                print("[BATCH] Could not write", outputFilename)
+                capture.release()
+                return filename, 0, time.time() - startTime, 0
+        pipeline.apply(frame)
+        videoWriter.write(frame)
+        numFrames += 1
+        if progressInterval and numFrames % progressInterval == 0:
+            print("[BATCH] {}: {}/{} frames".format(
+                os.path.basename(filename), numFrames, totalFrames or '?'))
+        success, frame = capture.read(frame)
+
+    capture.release()
+    if videoWriter is not None:
+        videoWriter.release()
+    else:
+        print("[BATCH] Could not read", filename)
+    return (filename, numFrames, time.time() - startTime,
+            os.path.getsize(filename))
+
+def run(filenames, outputDir, pipelineOptions, fourcc='MJPG', numWorkers=None,
+        progressInterval=100, shouldOverwrite=False):
+    """ Process every file, numWorkers at a time, reporting throughput
+
+    Files whose output already exists are skipped unless shouldOverwrite is
+    True. Raises ValueError, before processing anything, if two files would
+    be written to the same output or an output would be one of the inputs.
+    """
+    outputFilenames = createOutputFilenames(filenames, outputDir)
+    tasks = []
+    for filename, outputFilename in zip(filenames, outputFilenames):
+        if os.path.exists(outputFilename) and not shouldOverwrite:
+            print("[BATCH] Skipping {}: {} already exists".format(
+                filename, outputFilename))
+            continue
+        outputSubdir = os.path.dirname(outputFilename)
+        if outputSubdir and not os.path.isdir(outputSubdir):
+            os.makedirs(outputSubdir)
+        tasks.append((filename, outputFilename, pipelineOptions, fourcc,
+                      progressInterval))
+
+    numWorkers = min(numWorkers or multiprocessing.cpu_count(), len(tasks))
+    if numWorkers <= 1:
+        pool = None
+        results = map(processFile, tasks)
+    else:
+        pool = multiprocessing.Pool(numWorkers)
+        results = pool.imap_unordered(processFile, tasks)
+
+    startTime = time.time()
+    totalFrames = 0
+    totalBytes = 0
+    for filename, numFrames, seconds, numBytes in results:
+        totalFrames += numFrames
+        totalBytes += numBytes
+        print("[BATCH] Done {}: {} frames in {:.1f} s, "
+              "{:.1f} frames/s, {:.1f} MB/s".format(
+                  filename, numFrames, seconds,
+                  numFrames / max(seconds, 1e-9),
+                  numBytes / 1e6 / max(seconds, 1e-9)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    seconds = time.time() - startTime
+    print("[BATCH] {} files, {} frames in {:.1f} s: "
+          "{:.1f} frames/s, {:.1f} MB/s".format(
+              len(tasks), totalFrames, seconds,
+              totalFrames / max(seconds, 1e-9),
+              totalBytes / 1e6 / max(seconds, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the Cameo pipeline over video files and images')
+    parser.add_argument('inputs', nargs='+',
+                        help='input files or glob patterns')
+    parser.add_argument('--output-dir', default='output')
+    parser.add_argument('--curve', default='provia',
+                        choices=sorted(CURVE_FILTERS) + ['none'])
+    parser.add_argument('--swap-faces', action='store_true')
+    parser.add_argument('--blend-faces', action='store_true',
+                        help='blend swapped faces with feathered masks')
+    parser.add_argument('--debug-rects', action='store_true')
+    parser.add_argument('--motion-gate', action='store_true',
+                        help='skip tracking on static frames and refilter '
+                             'only the tiles that changed')
+    parser.add_argument('--no-stroke-edges', action='store_true')
+    parser.add_argument('--fourcc', default='MJPG',
+                        help='codec of the output videos')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='files processed at once (default: one per core)')
+    parser.add_argument('--progress-interval', type=int, default=100,
+                        help='frames between progress reports (0 for none)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace outputs that already exist')
+    args = parser.parse_args()
+
+    filenames = expandInputs(args.inputs)
+    if not filenames:
+        parser.error('no input files match')
+
+    pipelineOptions = {
+        'shouldSwapFaces': args.swap_faces,
+        'shouldStrokeEdges': not args.no_stroke_edges,
+        'curveName': None if args.curve == 'none' else args.curve,
+        'shouldDrawDebugRects': args.debug_rects,
+        'shouldBlendFaces': args.blend_faces,
+        'shouldGateMotion': args.motion_gate}
+    try:
+        run(filenames, args.output_dir, pipelineOptions, args.fourcc,
+            args.workers, args.progress_interval, args.overwrite)
+    except ValueError as error:
+        parser.error(str(error))
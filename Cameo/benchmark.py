@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+""" Benchmark the filters, rectangle copies and face tracking
+
+Each case is timed on synthetic frames at several resolutions, after some
+warmup calls. It reports the median ms/frame, megapixels per second and
+the peak memory the call allocates through Python (NumPy arrays included,
+OpenCV's internal buffers not).
+
+Usage: python benchmark.py [--resolutions 640x480 1920x1080] [--cases curve]
+           [--output results.json] [--baseline old.json [--tolerance 0.2]]
+
+With a baseline, any case more than tolerance slower than in the baseline
+is listed and the script exits with status 1.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy
+
+import filters
+from motion import MotionGate, TiledFilterCache
+import parallel
+import rects
+from trackers import FaceTracker
+
+
+DEFAULT_RESOLUTIONS = ['640x480', '1280x720', '1920x1080']
+
+
+def createRandomFrame(width, height):
+    """ Return a BGR frame of random bytes, as in randombits.py """
+    randomByteArray = bytearray(os.urandom(width * height * 3))
+    return numpy.array(randomByteArray, numpy.uint8).reshape(height, width, 3)
+
+def createFaceFrame(width, height, numFaces=2):
+    """ Return a BGR frame with numFaces crude faces on a textured background
+
+    Each face is a skin-toned ellipse with dark eyes, nose and mouth, which
+    gives the trackers and face swaps realistic regions to work on. The
+    frame is softened in proportion to the faces' size, as a camera would,
+    which the face cascade needs to find them at every resolution.
+    """
+    frame = cv2.GaussianBlur(createRandomFrame(width, height), (0,0), 3)
+    faceRects = []
+    faceSize = min(width // (numFaces + 1), height // 2)
+    for i in range(numFaces):
+        x = (i + 1) * width // (numFaces + 1) - faceSize // 2
+        y = height // 2 - faceSize // 2
+        faceRects.append((x, y, faceSize, faceSize))
+        center = (x + faceSize // 2, y + faceSize // 2)
+        cv2.ellipse(frame, center, (faceSize * 2 // 5, faceSize // 2), 0, 0,
+                    360, (150, 170, 210), -1)
+        for eyeX in (x + faceSize * 3 // 10, x + faceSize * 7 // 10):
+            cv2.ellipse(frame, (eyeX, y + faceSize * 2 // 5),
+                        (max(1, faceSize // 10), max(1, faceSize // 20)),
+                        0, 0, 360, (40, 30, 30), -1)
+        cv2.line(frame, center, (center[0], center[1] + faceSize // 8),
+                 (90, 100, 140), max(1, faceSize // 40))
+        cv2.ellipse(frame, (center[0], y + faceSize * 3 // 4),
+                    (faceSize // 6, faceSize // 20), 0, 0, 360,
+                    (60, 60, 150), -1)
+    cv2.GaussianBlur(frame, (0,0), max(1.0, faceSize / 150.0), frame)
+    return frame, faceRects
+
+
+def _legacyRecolorRC(src, dst):
+    """ recolorRC as it was, with split and merge, for comparison """
+    b, g, r = cv2.split(src)
+    cv2.addWeighted(b, 0.5, g, 0.5, 0, b)
+    cv2.merge((b, b, r), dst)
+
+def _legacyRecolorRGV(src, dst):
+    b, g, r = cv2.split(src)
+    cv2.min(b, g, b)
+    cv2.min(b, r, b)
+    cv2.merge((b, g, r), dst)
+
+def _legacyRecolorCMV(src, dst):
+    b, g, r = cv2.split(src)
+    cv2.max(b, g, b)
+    cv2.max(b, r, b)
+    cv2.merge((b, g, r), dst)
+
+
+def _filterCase(filter):
+    func = getattr(filter, 'apply', filter)
+    def setup(frame, faceRects):
+        dst = frame.copy()
+        return lambda: func(frame, dst)
+    return setup
+
+def _stripedFilterCase(createFilter, numWorkers):
+    def setup(frame, faceRects):
+        filter = createFilter()
+        executor = parallel.StripeExecutor(filter, numWorkers=numWorkers)
+        # The stripes must add up to exactly the serial output
+        expected = numpy.empty_like(frame)
+        filter.apply(frame, expected)
+        dst = numpy.empty_like(frame)
+        try:
+            executor.apply(frame, dst)
+            assert numpy.array_equal(dst, expected), \
+                'striped output differs from serial output'
+        except Exception:
+            executor.close()
+            raise
+        def run():
+            executor.apply(frame, dst)
+        # runBenchmarks shuts the workers down once the case is timed
+        run.close = executor.close
+        return run
+    return setup
+
+def _motionGatedCase(isStatic):
+    """ The Cameo chain behind a motion gate, on a static frame or on
+    frames whose first face alternates with its negative """
+    def setup(frame, faceRects):
+        frames = [frame, frame.copy()]
+        if not isStatic:
+            x, y, w, h = faceRects[0]
+            cv2.bitwise_not(frame[y:y+h, x:x+w], frames[1][y:y+h, x:x+w])
+        filterChain = _createCameoChain()
+        motionGate = MotionGate()
+        filterCache = TiledFilterCache(filterChain)
+        dst = numpy.empty_like(frame)
+        motionGate.update(frame)
+        filterCache.apply(frame, dst)
+        frameIndices = [0]
+        def run():
+            frameIndices[0] = 1 - frameIndices[0]
+            nextFrame = frames[frameIndices[0]]
+            motionGate.update(nextFrame)
+            filterCache.apply(nextFrame, dst, motionGate.dirtyRects)
+        return run
+    return setup
+
+def _inPlaceFilterCase(filter):
+    def setup(frame, faceRects):
+        return lambda: filter(frame, frame)
+    return setup
+
+def _swapCase(shouldBlend=False):
+    def setup(frame, faceRects):
+        dst = frame.copy()
+        return lambda: rects.swapRects(frame, dst, faceRects,
+                                       shouldBlend=shouldBlend)
+    return setup
+
+def _inPlaceSwapCase(frame, faceRects):
+    # Cameo swaps within the frame it captured, and the faces differ in size
+    work = frame.copy()
+    x, y, w, h = faceRects[-1]
+    swapRects = faceRects[:-1] + [(x, y, w * 3 // 4, h * 3 // 4)]
+    return lambda: rects.swapRects(work, work, swapRects)
+
+def _copyRectCase(frame, faceRects):
+    dst = frame.copy()
+    srcRect = faceRects[0]
+    x, y, w, h = faceRects[-1]
+    dstRect = (x, y, w * 3 // 4, h * 3 // 4)
+    return lambda: rects.copyRect(frame, dst, srcRect, dstRect)
+
+def _checkFacesFound(tracker, frame, faceRects):
+    """ Fail unless the tracker finds as many faces as the frame has """
+    tracker.update(frame)
+    assert len(tracker.faces) == len(faceRects), \
+        'the tracker found {} of {} faces'.format(len(tracker.faces),
+                                                 len(faceRects))
+
+def _trackerCase(**trackerOptions):
+    def setup(frame, faceRects):
+        tracker = FaceTracker(**trackerOptions)
+        _checkFacesFound(tracker, frame, faceRects)
+        return lambda: tracker.update(frame)
+    return setup
+
+def _createCameoChain():
+    return filters.FilterChain([
+        filters.StrokeEdgesFilter(), filters.BGRProviaCurveFilter()])
+
+def _cameoPipelineCase(frame, faceRects):
+    tracker = FaceTracker()
+    _checkFacesFound(tracker, frame, faceRects)
+    filterChain = _createCameoChain()
+    work = frame.copy()
+    def run():
+        work[:] = frame
+        tracker.update(work)
+        # Swap the known faces, so the swap is timed whatever is detected
+        rects.swapRects(work, work, faceRects)
+        filterChain.apply(work, work)
+    return run
+
+CASES = [
+    ('curve.portra', _filterCase(filters.BGRPortraCurveFilter())),
+    ('curve.provia', _filterCase(filters.BGRProviaCurveFilter())),
+    ('curve.velvia', _filterCase(filters.BGRVelviaCurveFilter())),
+    ('curve.crossprocess', _filterCase(filters.BGRCrossProcessCurveFilter())),
+    ('recolor.rc', _filterCase(filters.recolorRC)),
+    ('recolor.rgv', _filterCase(filters.recolorRGV)),
+    ('recolor.cmv', _filterCase(filters.recolorCMV)),
+    ('recolor.rc.inPlace', _inPlaceFilterCase(filters.recolorRC)),
+    ('recolor.rgv.inPlace', _inPlaceFilterCase(filters.recolorRGV)),
+    ('recolor.cmv.inPlace', _inPlaceFilterCase(filters.recolorCMV)),
+    ('recolor.rc.legacy', _filterCase(_legacyRecolorRC)),
+    ('recolor.rgv.legacy', _filterCase(_legacyRecolorRGV)),
+    ('recolor.cmv.legacy', _filterCase(_legacyRecolorCMV)),
+    ('strokeEdges', _filterCase(filters.strokeEdges)),
+    ('strokeEdges.filter', _filterCase(filters.StrokeEdgesFilter())),
+    ('convolution.sharpen', _filterCase(filters.SharpenFilter())),
+    ('convolution.findEdges', _filterCase(filters.FindEdgesFilter())),
+    ('convolution.blur', _filterCase(filters.BlurFilter())),
+    ('convolution.emboss', _filterCase(filters.EmbossFilter())),
+    ('chain.cameo', _filterCase(_createCameoChain())),
+    ('chain.cameo.gated.static', _motionGatedCase(isStatic=True)),
+    ('chain.cameo.gated.face', _motionGatedCase(isStatic=False)),
+    ('chain.cameo.stripes2', _stripedFilterCase(_createCameoChain, 2)),
+    ('chain.cameo.stripes4', _stripedFilterCase(_createCameoChain, 4)),
+    ('rects.copyRect', _copyRectCase),
+    ('rects.swapRects', _swapCase()),
+    ('rects.swapRects.blend', _swapCase(shouldBlend=True)),
+    ('rects.swapRects.inPlace', _inPlaceSwapCase),
+    ('tracker.update', _trackerCase()),
+    ('tracker.update.interval5', _trackerCase(detectionInterval=5)),
+    ('pipeline.cameo', _cameoPipelineCase),
+]
+
+
+def timeCase(func, numWarmups, numRepeats):
+    """ Return (median seconds per call, peak bytes allocated by a call) """
+    for _ in range(numWarmups):
+        func()
+
+    times = []
+    for _ in range(numRepeats):
+        startTime = time.time()
+        func()
+        times.append(time.time() - startTime)
+
+    # Measured separately, since tracing slows the calls down
+    tracemalloc.start()
+    func()
+    _, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return float(numpy.median(times)), peakBytes
+
+def runBenchmarks(resolutions, caseNames=None, numWarmups=3, numRepeats=20):
+    results = {}
+    for resolution in resolutions:
+        width, height = [int(value) for value in resolution.split('x')]
+        frame, faceRects = createFaceFrame(width, height)
+        numPixels = width * height
+        results[resolution] = {}
+        for name, setup in CASES:
+            if caseNames and not any(caseName in name
+                                     for caseName in caseNames):
+                continue
+            func = setup(frame.copy(), faceRects)
+            try:
+                seconds, peakBytes = timeCase(func, numWarmups, numRepeats)
+            finally:
+                # Cases holding workers or other resources expose close()
+                if hasattr(func, 'close'):
+                    func.close()
+            results[resolution][name] = {
+                'msPerFrame': 1000.0 * seconds,
+                'mpixPerSecond': numPixels / 1e6 / max(seconds, 1e-9),
+                'peakAllocBytes': peakBytes}
+            print("{:>10} {:<26} {:>9.3f} ms {:>9.1f} MPix/s {:>9.1f} MB".format(
+                resolution, name, 1000.0 * seconds,
+                numPixels / 1e6 / max(seconds, 1e-9), peakBytes / 1e6))
+    return results
+
+def findRegressions(results, baseline, tolerance):
+    """ Return (resolution, case, ms, baseline ms) for each slower case """
+    regressions = []
+    for resolution, cases in results.items():
+        for name, result in cases.items():
+            baselineResult = baseline.get(resolution, {}).get(name)
+            if baselineResult is None:
+                continue
+            baselineMs = baselineResult['msPerFrame']
+            if result['msPerFrame'] > baselineMs * (1.0 + tolerance):
+                regressions.append((resolution, name, result['msPerFrame'],
+                                    baselineMs))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Cameo filters, rects and trackers')
+    parser.add_argument('--resolutions', nargs='+',
+                        default=DEFAULT_RESOLUTIONS,
+                        help='WIDTHxHEIGHT frame sizes')
+    parser.add_argument('--cases', nargs='+', default=None,
+                        help='only run cases whose names contain one of these')
+    parser.add_argument('--warmups', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--baseline',
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.resolutions, args.cases, args.warmups,
+                            args.repeats)
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = findRegressions(results, baseline, args.tolerance)
+        for resolution, name, ms, baselineMs in regressions:
+            print("[BENCHMARK] Regression: {} {} {:.3f} ms (baseline "
+                  "{:.3f} ms)".format(resolution, name, ms, baselineMs))
+        if regressions:
+            sys.exit(1)
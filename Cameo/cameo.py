@@ -1,53 +1,136 @@
 #!/usr/bin/env python
 
+import time
+_importStartTime = time.time()
+
 import cv2
+import logging
+import os
 from managers import WindowManager, CaptureManager
 import filters
+from governor import QualityGovernor
+from motion import MotionGate, TiledFilterCache
 import rects
 from trackers import FaceTracker
+import utils
+
+_importEndTime = time.time()
+
+# Compiled curve lookups, so later starts needn't evaluate the curves
+LOOKUP_CACHE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'lookups.npz')
 
 
 class Cameo(object):
 
     def __init__(self):
+        self._initStartTime = time.time()
         self._windowManager = WindowManager('Cameo', self.onKeypress)
         self._captureManager = CaptureManager(cv2.VideoCapture(0),
-                    self._windowManager, True)
-        self._curveFilter = filters.BGRProviaCurveFilter()
+                    self._windowManager, True, shouldProfile=True)
+
+        utils.loadLookupCache(LOOKUP_CACHE_FILE)
+        self._strokeEdgesFilter = filters.StrokeEdgesFilter()
+        self._filterChain = filters.FilterChain([
+            self._strokeEdgesFilter,
+            filters.BGRProviaCurveFilter()])
+        # Save again whenever the filters needed arrays the file lacks
+        if utils.isLookupCacheDirty():
+            utils.saveLookupCache(LOOKUP_CACHE_FILE)
+
         self._faceTracker = FaceTracker()
+        # Skips tracking on static frames and refilters only changed tiles
+        self._motionGate = MotionGate()
+        self._filterCache = TiledFilterCache(self._filterChain)
+        self._shouldGateMotion = False
+        self._previousFaceRects = []
+        # Lowers detection and filter quality when frames take too long
+        self._governor = QualityGovernor(30.0, self._faceTracker,
+                                         self._strokeEdgesFilter)
         self._shouldDrawDebugRects = False
+        self._shouldBlendFaces = False
+        self._initEndTime = time.time()
 
     def run(self):
         """ Run the main loop """
 
         self._windowManager.createWindow()
         print("Window '{}' Created".format(self._windowManager.windowName))
-        print("\n{}\n{}\n{}\n{}".format("Controls:",
+        print("\n{}\n{}\n{}\n{}\n{}\n{}\n{}\n{}\n{}\n{}".format(
+                "Controls:",
                 "space   --> Take a screenshot",
                 "tab     --> Start/stop recording a screencast",
+                "r       --> Start/stop recording raw frames",
+                "x       --> Toggle drawing debug rectangles around faces",
+                "b       --> Toggle blending swapped faces",
+                "p       --> Toggle the FPS and latency overlay",
+                "g       --> Toggle adapting quality to hold 30 FPS",
+                "m       --> Toggle skipping work on static frames",
                 "escape  --> Quit"))
 
         while self._windowManager.isWindowCreated:
             self._captureManager.enterFrame()
             frame = self._captureManager.frame
+            self._governor.startFrame()
 
-            self._faceTracker.update(frame)
-            faces = self._faceTracker.faces
-            rects.swapRects(frame, frame, [face.faceRect for face in faces])
+            profiler = self._captureManager.profiler
+
+            profiler.start('track')
+            if self._shouldGateMotion:
+                self._motionGate.update(frame)
+            # A static scene keeps the previous frame's faces
+            if not (self._shouldGateMotion and self._motionGate.isStatic):
+                self._faceTracker.update(frame)
+            faceRects = [face.faceRect for face in self._faceTracker.faces]
+            profiler.stop('track')
+
+            profiler.start('swap')
+            rects.swapRects(frame, frame, faceRects,
+                            shouldBlend=self._shouldBlendFaces)
+            profiler.stop('swap')
 
             # Add filtering to the frame
-            filters.strokeEdges(frame,frame)
-            self._curveFilter.apply(frame,frame)
+            profiler.start('filter')
+            if self._shouldGateMotion:
+                # The swapped faces, and where they were, count as changed
+                self._filterCache.apply(frame, frame,
+                    self._motionGate.dirtyRects + faceRects +
+                    self._previousFaceRects)
+            else:
+                self._filterChain.apply(frame,frame)
+            self._previousFaceRects = faceRects
+            profiler.stop('filter')
 
             if self._shouldDrawDebugRects:
                 self._faceTracker.drawDebugRects(frame)
 
             self._captureManager.exitFrame()
+            if self._governor.endFrame():
+                self._filterCache.invalidate()
+                print("[CAMEO] Quality level {level}: detection every "
+                      "{detectionInterval} frames at width {detectionWidth}, "
+                      "scale factor {scaleFactor}, edge kernels {blurKsize}/"
+                      "{edgeKsize}".format(**self._governor.decisions))
+            if self._initEndTime is not None:
+                self._printStartupTimes()
+                self._initEndTime = None
             self._windowManager.processEvents()
 
+    def _printStartupTimes(self):
+        """ Report how long the first frame took to appear, by phase """
+        firstFrameTime = time.time()
+        print("[CAMEO] Time to first frame: {:.0f} ms".format(
+            1000 * (firstFrameTime - _importStartTime)))
+        print("        imports     {:.0f} ms".format(
+            1000 * (_importEndTime - _importStartTime)))
+        print("        setup       {:.0f} ms".format(
+            1000 * (self._initEndTime - self._initStartTime)))
+        print("        first frame {:.0f} ms".format(
+            1000 * (firstFrameTime - self._initEndTime)))
+
     def stop(self):
         print("[CAMEO] closing all processes")
-        self._captureManager._capture.release()
+        self._captureManager.release()
         self._windowManager.destroyWindow()
 
 
@@ -57,7 +140,12 @@ class Cameo(object):
 
         space   --> Take a screenshot
         tab     --> Start/stop recording a screencast
+        r       --> Start/stop recording raw frames
         x       --> Toggle drawing debug rectangles around faces
+        b       --> Toggle blending swapped faces
+        p       --> Toggle the FPS and latency overlay
+        g       --> Toggle adapting quality to hold 30 FPS
+        m       --> Toggle skipping work on static frames
         escape  --> Quit
         """
 
@@ -71,12 +159,39 @@ class Cameo(object):
             else:
                 self._captureManager.stopWritingVideo()
                 print("Stopped writing video")
+        elif keycode == 114: # r
+            if not self._captureManager.isWritingFrames:
+                self._captureManager.startWritingFrames('screencast.frames')
+                print("Writing raw frames to file...")
+            else:
+                self._captureManager.stopWritingFrames()
+                print("Stopped writing raw frames")
         elif keycode == 120: # x
             self._shouldDrawDebugRects = not self._shouldDrawDebugRects
             print("Toggled drawing rectangles")
+        elif keycode == 98: # b
+            self._shouldBlendFaces = not self._shouldBlendFaces
+            print("Toggled blending swapped faces")
+        elif keycode == 112: # p
+            self._captureManager.shouldDrawProfile = \
+                not self._captureManager.shouldDrawProfile
+            print("Toggled the profile overlay")
+        elif keycode == 103: # g
+            self._governor.isEnabled = not self._governor.isEnabled
+            if not self._governor.isEnabled:
+                self._governor.setLevel(0)
+            self._filterCache.invalidate()
+            print("Toggled adapting quality")
+        elif keycode == 109: # m
+            self._shouldGateMotion = not self._shouldGateMotion
+            self._motionGate.reset()
+            self._filterCache.invalidate()
+            print("Toggled skipping work on static frames")
         elif keycode == 27: # escape
             print("Closing Window...")
             self._windowManager.destroyWindow()
 
 if __name__ == '__main__':
+    logging.basicConfig()
     cameo = Cameo()
+    cameo.run()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+""" Compare downscaled face detection with full-resolution detection
+
+Runs a FaceTracker at full resolution and one per detection width over
+every frame of a recorded clip or raw frame store, and reports each width's
+mean detection time and how well its faces agree with the full-resolution
+ones.
+
+Usage: python comparedetection.py clip.avi [--widths 320 480 auto]
+"""
+
+import argparse
+import cv2
+import time
+
+import framestore
+import rects
+from trackers import FaceTracker
+
+
+def matchFaces(referenceRects, testRects, minOverlap=0.5):
+    """ Return how many reference rectangles a test rectangle overlaps """
+    unmatchedRects = list(testRects)
+    numMatched = 0
+    for referenceRect in referenceRects:
+        for testRect in unmatchedRects:
+            if rects.intersectionOverUnion(referenceRect, testRect) >= \
+                    minOverlap:
+                unmatchedRects.remove(testRect)
+                numMatched += 1
+                break
+    return numMatched
+
+
+def compare(filename, widths, maxFrames=None):
+    trackers = [(None, FaceTracker())]
+    for width in widths:
+        if width != 'auto':
+            width = int(width)
+        trackers.append((width, FaceTracker(detectionWidth=width)))
+
+    times = dict((width, 0.0) for width, _ in trackers)
+    numReference = 0
+    numDetected = dict((width, 0) for width, _ in trackers)
+    numMatched = dict((width, 0) for width, _ in trackers)
+    numFrames = 0
+
+    capture = framestore.openCapture(filename)
+    success, frame = capture.read()
+    while success and (maxFrames is None or numFrames < maxFrames):
+        referenceRects = None
+        for width, tracker in trackers:
+            startTime = time.time()
+            tracker.update(frame)
+            times[width] += time.time() - startTime
+
+            faceRects = [face.faceRect for face in tracker.faces]
+            if referenceRects is None:
+                referenceRects = faceRects
+                numReference += len(faceRects)
+            numDetected[width] += len(faceRects)
+            numMatched[width] += matchFaces(referenceRects, faceRects)
+        numFrames += 1
+        success, frame = capture.read()
+    capture.release()
+
+    if numFrames == 0:
+        print("No frames could be read from", filename)
+        return
+
+    print("{} frames, {} faces at full resolution".format(
+        numFrames, numReference))
+    print("{:>8} {:>10} {:>8} {:>8} {:>10}".format(
+        "width", "ms/frame", "speedup", "recall", "precision"))
+    fullTime = times[None]
+    for width, _ in trackers:
+        recall = float(numMatched[width]) / max(1, numReference)
+        precision = float(numMatched[width]) / max(1, numDetected[width])
+        print("{:>8} {:>10.2f} {:>8.2f} {:>8.3f} {:>10.3f}".format(
+            'full' if width is None else width,
+            1000.0 * times[width] / numFrames,
+            fullTime / max(times[width], 1e-9), recall, precision))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare downscaled and full-resolution face detection')
+    parser.add_argument('clip', help='a recorded video file')
+    parser.add_argument('--widths', nargs='+', default=['320', '480', 'auto'],
+                        help="detection widths to compare, or 'auto'")
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+    compare(args.clip, args.widths, args.max_frames)
@@ -1,7 +1,15 @@
 import cv2
 import numpy
+import threading
 import utils
 
+# The recolors work through the frame in bands of rows of about this size,
+# so that each band's temporary stays in cache
+RECOLOR_BAND_BYTES = 1 << 18
+
+# Each thread's band temporary, kept between calls
+_recolorScratch = threading.local()
+
 def recolorRC(src, dst):
     """ Simulate conversion from BGR to RC (red, cyan).
 
@@ -13,10 +21,10 @@ def recolorRC(src, dst):
     dst.b = dst.g = 0.5*(src.b + src.g)
     dst.r = src.r
 
+    Halves are rounded to even, exactly as with cv2.addWeighted on split
+    planes.
     """
-    b,g,r = cv2.split(src)
-    cv2.addWeighted(b,0.5,g,0.5,0,b)
-    cv2.merge((b,b,r),dst)
+    _recolorInBands(src, dst, _averageBlueGreen, [0,0, 0,1])
 
 
 def recolorRGV(src, dst):
@@ -30,11 +38,7 @@ def recolorRGV(src, dst):
     dst.r = src.r
 
     """
-
-    b,g,r = cv2.split(src)
-    cv2.min(b,g,b)
-    cv2.min(b,r,b)
-    cv2.merge((b,g,r),dst)
+    _recolorInBands(src, dst, _minOfBGR, [0,0])
 
 def recolorCMV(src,dst):
     """ Simulate conversion from BGR to CMV (Cyan, Magenta, value)
@@ -44,12 +48,58 @@ def recolorCMV(src,dst):
     dst.g = src.g
     dst.r = src.r
     """
+    _recolorInBands(src, dst, _maxOfBGR, [0,0])
+
+def _averageBlueGreen(rows, results):
+    cv2.addWeighted(rows[:,:-1], 0.5, rows[:,1:], 0.5, 0, results[:,:-1])
+
+def _minOfBGR(rows, results):
+    cv2.min(rows[:,:-2], rows[:,1:-1], results[:,:-2])
+    cv2.min(results[:,:-2], rows[:,2:], results[:,:-2])
 
-    b,g,r = cv2.split(src)
-    cv2.max(b,g,b)
-    cv2.max(b,r,b)
-    cv2.merge((b,g,r),dst)
+def _maxOfBGR(rows, results):
+    cv2.max(rows[:,:-2], rows[:,1:-1], results[:,:-2])
+    cv2.max(results[:,:-2], rows[:,2:], results[:,:-2])
 
+def _recolorInBands(src, dst, bandFunc, fromTo):
+    """ Recolor dst from src without splitting the frame into planes
+
+    Each band of rows of the interleaved frame is viewed as 2-D rows of
+    bytes. bandFunc(rows, results) combines the rows with themselves
+    shifted by a byte or two, which puts each pixel's result at its blue
+    byte, and mixChannels copies the results into the channels of fromTo.
+    src may be dst, and either may be a region of a larger frame.
+    """
+    if dst is not src:
+        numpy.copyto(dst, src)
+    itemSize = dst.dtype.itemsize
+    if dst.strides[1:] != (3 * itemSize, itemSize):
+        # The pixels aren't packed, so the rows can't be viewed as bytes
+        packed = numpy.ascontiguousarray(dst)
+        _recolorInBands(packed, packed, bandFunc, fromTo)
+        dst[...] = packed
+        return
+
+    numRows = max(1, RECOLOR_BAND_BYTES // max(1, dst[0].nbytes))
+    numRows = min(numRows, dst.shape[0])
+    rowLength = dst.shape[1] * 3
+    scratch = getattr(_recolorScratch, 'array', None)
+    if scratch is None or scratch.shape != (numRows, rowLength) or \
+            scratch.dtype != dst.dtype:
+        scratch = numpy.empty((numRows, rowLength), dst.dtype)
+        _recolorScratch.array = scratch
+    for y in range(0, dst.shape[0], numRows):
+        band = dst[y:y+numRows]
+        results = scratch[:len(band)]
+        bandFunc(band.reshape(len(band), rowLength), results)
+        cv2.mixChannels([results.reshape(band.shape)], [band], fromTo)
+
+
+def strokeEdgesHalo(blurKsize=7, edgeKsize=5):
+    """ The halo of strokeEdges: the blur and edge kernels' radii combined """
+    if blurKsize < 3:
+        blurKsize = 1
+    return blurKsize // 2 + edgeKsize // 2
 
 def strokeEdges(src,dst,blurKsize=7,edgeKsize=5):
     if blurKsize >= 3:
@@ -65,57 +115,153 @@ def strokeEdges(src,dst,blurKsize=7,edgeKsize=5):
     cv2.merge(channels, dst)
 
 
+class StrokeEdgesFilter(object):
+    """ strokeEdges as a filter that reuses its working buffers
+
+    The buffers are allocated on first use and again only when the frame's
+    shape changes. The edge alpha stays 8-bit and the frame is multiplied by
+    it with rounding (strokeEdges truncates), so results can differ from
+    strokeEdges by one level.
+    """
+
+    def __init__(self, blurKsize=7, edgeKsize=5):
+        self.blurKsize = blurKsize
+        self.edgeKsize = edgeKsize
+
+        self._blurredSrc = None
+        self._graySrc = None
+        self._inverseAlpha = None
+
+    @property
+    def halo(self):
+        return strokeEdgesHalo(self.blurKsize, self.edgeKsize)
+
+    def apply(self, src, dst):
+        """ Apply the filter with a BGR or gray source/destination """
+        self._ensureBuffers(src)
+        if self.blurKsize >= 3:
+            cv2.medianBlur(src, self.blurKsize, self._blurredSrc)
+            blurredSrc = self._blurredSrc
+        else:
+            blurredSrc = src
+        if utils.isGray(src):
+            self._graySrc[:] = blurredSrc
+        else:
+            cv2.cvtColor(blurredSrc, cv2.COLOR_BGR2GRAY, self._graySrc)
+        cv2.Laplacian(self._graySrc, cv2.CV_8U, self._graySrc,
+                      ksize=self.edgeKsize)
+
+        # 255 - edges is the inverse alpha, scaled to [0,255]
+        cv2.bitwise_not(self._graySrc, self._graySrc)
+        if utils.isGray(src):
+            inverseAlpha = self._graySrc
+        else:
+            cv2.cvtColor(self._graySrc, cv2.COLOR_GRAY2BGR, self._inverseAlpha)
+            inverseAlpha = self._inverseAlpha
+        cv2.multiply(src, inverseAlpha, dst, 1.0 / 255)
+
+    def _ensureBuffers(self, src):
+        if self._blurredSrc is not None and \
+                self._blurredSrc.shape == src.shape and \
+                self._blurredSrc.dtype == src.dtype:
+            return
+        self._blurredSrc = numpy.empty_like(src)
+        self._graySrc = numpy.empty(src.shape[:2], src.dtype)
+        self._inverseAlpha = None
+        if not utils.isGray(src):
+            self._inverseAlpha = numpy.empty_like(src)
+
+
 
 class VFuncFilter(object):
     """ A Filter that applies a function to V (or all of BGR) """
 
     def __init__(self, vFunc = None, dtype = numpy.uint8):
         length = numpy.iinfo(dtype).max + 1
-        self._vLookupArray = utils.createLookupArray(vFunc,length)
+        self._vLookupArray = utils.createLookupArray(vFunc,length,dtype)
+        self._lookupTable = utils.createLookupTable(
+            [self._vLookupArray], length)
 
     def apply(self, src, dst):
         """ Apply the filter with a BGR or gray source/destination."""
-        srcFlatView = utils.flatView(src)
-        dstFlatView = utils.flatView(dst)
+        if self._lookupTable is not None:
+            # 8-bit: a single pass over the interleaved frame
+            utils.applyLookupTable(self._lookupTable, src, dst)
+            return
+        srcFlatView = utils.createFlatView(src)
+        dstFlatView = utils.createFlatView(dst)
         utils.applyLookupArray(self._vLookupArray, srcFlatView, dstFlatView)
 
+    @property
+    def lookupTable(self):
+        """ The compiled 8-bit table, or None if the filter isn't 8-bit """
+        return self._lookupTable
+
+    @property
+    def halo(self):
+        """ Lookups are pointwise, so no neighbours are needed """
+        return 0
+
 class VCurveFilter(VFuncFilter):
     """ A filter that applies a curve to V (or all of BGR)
         Extends the VFuncFilter class
         """
     def __init__(self, vPoints, dtype = numpy.uint8):
-        VFuncFilter.__init__(self, utils.createCurveFunc(vPoints),dtype)
+        length = numpy.iinfo(dtype).max + 1
+        VFuncFilter.__init__(self,
+            utils.createCurveFunc(utils.scaleCurvePoints(vPoints, length)),
+            dtype)
 
 class BGRFuncFilter(object):
     """ A filter that applies different functions to each of BGR """
 
     def __init__(self,vFunc=None,bFunc=None,gFunc=None,rFunc=None,dtype=numpy.uint8):
         length = numpy.iinfo(dtype).max + 1
-        print("length parameter:",length)
         self._bLookupArray = utils.createLookupArray(
-            utils.createCompositeFunc(bFunc,vFunc),length)
+            utils.createCompositeFunc(bFunc,vFunc),length,dtype)
         self._gLookupArray = utils.createLookupArray(
-            utils.createCompositeFunc(gFunc,vFunc),length)
+            utils.createCompositeFunc(gFunc,vFunc),length,dtype)
         self._rLookupArray = utils.createLookupArray(
-            utils.createCompositeFunc(rFunc,vFunc),length)
+            utils.createCompositeFunc(rFunc,vFunc),length,dtype)
+
+        # Compile the three lookups once into a single (256,1,3) table so that
+        # 8-bit frames are mapped in place without splitting or merging
+        self._lookupTable = utils.createLookupTable(
+            [self._bLookupArray, self._gLookupArray, self._rLookupArray],
+            length)
 
     def apply(self, src, dst):
         """ Apply the filter with a BGR source/destination"""
+        if self._lookupTable is not None:
+            utils.applyLookupTable(self._lookupTable, src, dst)
+            return
         b,g,r = cv2.split(src)
         utils.applyLookupArray(self._bLookupArray,b,b)
         utils.applyLookupArray(self._gLookupArray,g,g)
         utils.applyLookupArray(self._rLookupArray,r,r)
         cv2.merge((b,g,r), dst)
 
+    @property
+    def lookupTable(self):
+        """ The compiled 8-bit table, or None if the filter isn't 8-bit """
+        return self._lookupTable
+
+    @property
+    def halo(self):
+        """ Lookups are pointwise, so no neighbours are needed """
+        return 0
+
 class BGRCurveFilter(BGRFuncFilter):
     """ A filter that applies different curves to each of v,b,g and r """
     def __init__(self, vPoints=None,bPoints=None,gPoints=None,rPoints=None,
             dtype=numpy.uint8):
+        # Points are given for 8-bit channels, so scale them for wider types
+        length = numpy.iinfo(dtype).max + 1
         BGRFuncFilter.__init__(self,
-                utils.createCurveFunc(vPoints),
-                utils.createCurveFunc(bPoints),
-                utils.createCurveFunc(gPoints),
-                utils.createCurveFunc(rPoints),
+                utils.createCurveFunc(utils.scaleCurvePoints(vPoints, length)),
+                utils.createCurveFunc(utils.scaleCurvePoints(bPoints, length)),
+                utils.createCurveFunc(utils.scaleCurvePoints(gPoints, length)),
+                utils.createCurveFunc(utils.scaleCurvePoints(rPoints, length)),
                 dtype)
 
 class BGRPortraCurveFilter(BGRCurveFilter):
@@ -177,6 +323,11 @@ class VConvolutionFilter(object):
         """ Apply the given filter with a BGR or Grayscale src/destination """
         cv2.filter2D(src,-1, self._kernel, dst)
 
+    @property
+    def halo(self):
+        """ How many rows/columns of neighbours each output pixel depends on """
+        return max(self._kernel.shape) // 2
+
 class SharpenFilter(VConvolutionFilter):
     """ A specific case of VConvolution Filter where the kernel's center output is 9x the value of
         its input -1 from the value of each of the surrounding pixels. This amplifies contrasts between
@@ -219,3 +370,133 @@ class EmbossFilter(VConvolutionFilter):
                               [-1, 8, 1],
                               [ 0, 1, 2]])
         VConvolutionFilter.__init__(self, kernel)
+
+
+# The recolor functions are pointwise, like the lookup filters
+POINTWISE_FUNCS = (recolorRC, recolorRGV, recolorCMV)
+
+# Pointwise filters process a batch in chunks of frames of about this size.
+# Small frames then cost one call per chunk, while each chunk's temporaries
+# still fit in cache (a whole stack at once is slower than frame by frame).
+BATCH_CHUNK_BYTES = 1 << 20
+
+def isPointwise(filter):
+    """ True if each output pixel depends only on the same input pixel """
+    return filter in POINTWISE_FUNCS or getattr(filter, 'halo', None) == 0
+
+def applyToBatch(filter, src, dst, chunkBytes=BATCH_CHUNK_BYTES):
+    """ Apply a filter to every frame of an (N, H, W[, C]) stack
+
+    src and dst may be arrays or memory-mapped stacks, and may be the same.
+    Pointwise filters (lookups, recolors and chains of them) are applied to
+    a chunk of frames at a time, viewed as one tall frame. Other filters are
+    applied frame by frame, since their kernels must not reach across frame
+    borders. Either way the results match per-frame calls exactly.
+    """
+    assert src.shape == dst.shape, 'src and dst stacks differ in shape'
+    func = getattr(filter, 'apply', filter)
+    numFrames = len(src)
+    if numFrames == 0:
+        return
+
+    chunkSize = 1
+    if isPointwise(filter):
+        chunkSize = max(1, chunkBytes // src[0].nbytes)
+    for start in range(0, numFrames, chunkSize):
+        stop = min(start + chunkSize, numFrames)
+        srcChunk = _stackFrames(src[start:stop])
+        dstChunk = _stackFrames(dst[start:stop])
+        if chunkSize == 1 or srcChunk is None or dstChunk is None:
+            for i in range(start, stop):
+                func(src[i], dst[i])
+        else:
+            func(srcChunk, dstChunk)
+
+def _stackFrames(frames):
+    """ View frames as one tall frame, or return None if that needs a copy """
+    view = frames.view(numpy.ndarray)
+    try:
+        view.shape = (-1,) + frames.shape[2:]
+    except AttributeError:
+        # e.g. frames interleaved with other fields of a record array
+        return None
+    return view
+
+
+class FilterChain(object):
+    """ Applies an ordered list of filters, fusing pointwise stages
+
+    Each filter is either an object with an apply(src, dst) method or a
+    function of the form func(src, dst). Consecutive filters exposing a
+    lookupTable (the curve filters) are composed ahead of time into one table,
+    so a run of them costs a single pass over the frame. Any other filter,
+    such as a VConvolutionFilter or strokeEdges, breaks the run and is
+    applied as is.
+    """
+
+    def __init__(self, filters=None):
+        self._filters = list(filters or [])
+        self._stages = []
+        self._compile()
+
+    @property
+    def filters(self):
+        """ The filters in the chain, in order """
+        return tuple(self._filters)
+
+    @filters.setter
+    def filters(self, value):
+        self._filters = list(value)
+        self._compile()
+
+    @property
+    def halo(self):
+        """ The combined halo of the chain, or None if a stage's is unknown """
+        halo = 0
+        for filter in self._filters:
+            if filter in POINTWISE_FUNCS:
+                # The recolor functions are plain functions, with no halo
+                continue
+            filterHalo = getattr(filter, 'halo', None)
+            if filterHalo is None:
+                return None
+            halo += filterHalo
+        return halo
+
+    def applyToBatch(self, src, dst):
+        """ Apply the chain to every frame of an (N, H, W, 3) stack """
+        applyToBatch(self, src, dst)
+
+    def append(self, filter):
+        """ Add a filter to the end of the chain """
+        self._filters.append(filter)
+        self._compile()
+
+    def apply(self, src, dst):
+        """ Apply the chain with a BGR source/destination """
+        if not self._stages:
+            if dst is not src:
+                dst[:] = src
+            return
+        self._stages[0](src, dst)
+        for stage in self._stages[1:]:
+            stage(dst, dst)
+
+    def _compile(self):
+        self._stages = []
+        lookupTable = None
+        for filter in self._filters:
+            filterLookupTable = getattr(filter, 'lookupTable', None)
+            if filterLookupTable is not None:
+                lookupTable = utils.composeLookupTables(
+                    lookupTable, filterLookupTable)
+                continue
+            if lookupTable is not None:
+                self._stages.append(self._createLookupStage(lookupTable))
+                lookupTable = None
+            self._stages.append(getattr(filter, 'apply', filter))
+        if lookupTable is not None:
+            self._stages.append(self._createLookupStage(lookupTable))
+
+    def _createLookupStage(self, lookupTable):
+        return lambda src, dst: utils.applyLookupTable(lookupTable, src, dst)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+""" A frame bus between processes, over shared memory
+
+The bus is a fixed ring of frame slots in one shared memory block, with a
+small metadata record per slot (frame id, timestamp and face rectangles) in
+another. Processes pass slot numbers through queues, so pixels are written
+once, by the capture process, and are never pickled or copied after that.
+
+A frame moves through three roles: a capture process fills a free slot,
+one of the detector processes finds its faces, and a render process swaps
+and filters the faces, writes the frame out and frees the slot. The render
+process receives the frames in capture order, whichever detector finished
+them first.
+
+Usage: python framebus.py clip.avi [--detectors 2] [--output out.avi]
+           [--slots 8] [--max-frames 300]
+"""
+
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import sys
+import time
+
+import cv2
+import numpy
+
+import filters
+import framestore
+import rects
+from trackers import FaceTracker
+
+# Only available on Python 3.8+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def createRecordDtype(maxFaces):
+    """ Return the dtype of a slot's metadata record """
+    return numpy.dtype([('frameId', '<i8'), ('timestamp', '<f8'),
+                        ('numFaces', '<i4'), ('faceRects', '<i4', (maxFaces, 4))])
+
+
+class FrameBus(object):
+    """ Shared memory frame slots and the queues that hand them on
+
+    Create the bus in the parent process and pass it to the child processes
+    as an argument; each child attaches to the same memory, which is
+    detached when it exits. The parent should close() and unlink() the
+    memory once the children have finished.
+    """
+
+    def __init__(self, frameShape, dtype=numpy.uint8, numSlots=8, maxFaces=8,
+                 numDetectors=1):
+        assert shared_memory is not None, \
+            'the frame bus needs multiprocessing.shared_memory'
+        assert numSlots > numDetectors, \
+            'the detectors would hold every slot'
+
+        self.frameShape = tuple(frameShape)
+        self.dtype = numpy.dtype(dtype)
+        self.numSlots = numSlots
+        self.maxFaces = maxFaces
+        self.numDetectors = numDetectors
+
+        # Children must share this process's resource tracker, or their own
+        # trackers would unlink the memory when they exit
+        resource_tracker.ensure_running()
+        frameBytes = int(numpy.prod(self.frameShape)) * self.dtype.itemsize
+        recordDtype = createRecordDtype(maxFaces)
+        self._frameMemory = shared_memory.SharedMemory(
+            create=True, size=frameBytes * numSlots)
+        self._recordMemory = shared_memory.SharedMemory(
+            create=True, size=recordDtype.itemsize * numSlots)
+
+        self._freeSlots = multiprocessing.Queue()
+        self._capturedSlots = multiprocessing.Queue()
+        self._detectedSlots = multiprocessing.Queue()
+        for slot in range(numSlots):
+            self._freeSlots.put(slot)
+
+        self._createViews()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_frames', '_records', '_pendingSlots'):
+            del state[key]
+        state['_frameMemory'] = self._frameMemory.name
+        state['_recordMemory'] = self._recordMemory.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._frameMemory = shared_memory.SharedMemory(
+            name=state['_frameMemory'])
+        self._recordMemory = shared_memory.SharedMemory(
+            name=state['_recordMemory'])
+        self._createViews()
+
+    def frame(self, slot):
+        """ The frame stored in a slot, as a view of the shared memory """
+        return self._frames[slot]
+
+    def record(self, slot):
+        """ A slot's metadata record, as a view of the shared memory """
+        return self._records[slot]
+
+    def getFaceRects(self, slot):
+        record = self._records[slot]
+        return [tuple(int(value) for value in faceRect)
+                for faceRect in record['faceRects'][:record['numFaces']]]
+
+    def setFaceRects(self, slot, faceRects):
+        """ Store up to maxFaces face rectangles in a slot's record """
+        faceRects = list(faceRects)[:self.maxFaces]
+        record = self._records[slot]
+        record['numFaces'] = len(faceRects)
+        if faceRects:
+            record['faceRects'][:len(faceRects)] = faceRects
+
+    # Capture
+
+    def acquireFreeSlot(self):
+        """ Return a free slot, waiting until the renderer frees one """
+        return self._freeSlots.get()
+
+    def submitCaptured(self, slot):
+        self._capturedSlots.put(slot)
+
+    def finishCapture(self):
+        """ Tell every detector that no more frames will come """
+        for _ in range(self.numDetectors):
+            self._capturedSlots.put(None)
+
+    # Detection
+
+    def takeCaptured(self):
+        """ Return a captured slot, or None once capture has finished """
+        return self._capturedSlots.get()
+
+    def submitDetected(self, slot):
+        """ Pass a slot on to the renderer; a detector ends by passing None """
+        self._detectedSlots.put(slot)
+
+    # Rendering
+
+    def takeDetected(self):
+        """ Return the detected slots in frame order, then None """
+        while self._nextFrameId not in self._pendingSlots:
+            if self._numDetectorsFinished == self.numDetectors:
+                return None
+            slot = self._detectedSlots.get()
+            if slot is None:
+                self._numDetectorsFinished += 1
+            else:
+                frameId = int(self._records[slot]['frameId'])
+                self._pendingSlots[frameId] = slot
+        self._nextFrameId += 1
+        return self._pendingSlots.pop(self._nextFrameId - 1)
+
+    def releaseSlot(self, slot):
+        self._freeSlots.put(slot)
+
+    def close(self):
+        """ Detach this process from the shared memory """
+        self._frames = None
+        self._records = None
+        self._frameMemory.close()
+        self._recordMemory.close()
+
+    def unlink(self):
+        """ Free the shared memory, from the process that created it """
+        self._frameMemory.unlink()
+        self._recordMemory.unlink()
+
+    def _createViews(self):
+        frames = numpy.ndarray((self.numSlots,) + self.frameShape, self.dtype,
+                               self._frameMemory.buf)
+        self._frames = list(frames)
+        self._records = numpy.ndarray((self.numSlots,),
+                                      createRecordDtype(self.maxFaces),
+                                      self._recordMemory.buf)
+        # The renderer's frames that arrived ahead of their turn
+        self._pendingSlots = {}
+        self._nextFrameId = 0
+        self._numDetectorsFinished = 0
+
+
+def runCapture(bus, filename, maxFrames=None):
+    """ Read a video file or raw frame store into the bus """
+    capture = None
+    try:
+        capture = framestore.openCapture(filename)
+        frameId = 0
+        while maxFrames is None or frameId < maxFrames:
+            slot = bus.acquireFreeSlot()
+            frame = bus.frame(slot)
+            success, capturedFrame = capture.read(frame)
+            if not success:
+                bus.releaseSlot(slot)
+                break
+            if capturedFrame is not frame:
+                frame[...] = capturedFrame
+            record = bus.record(slot)
+            record['frameId'] = frameId
+            record['timestamp'] = time.time()
+            record['numFaces'] = 0
+            bus.submitCaptured(slot)
+            frameId += 1
+    finally:
+        # The detectors must hear that capture ended, even if it failed
+        if capture is not None:
+            capture.release()
+        bus.finishCapture()
+
+def runDetector(bus):
+    """ Find the faces in captured frames, until capture finishes
+
+    Each detector sees only some of the frames, so it detects on every
+    frame rather than tracking between them.
+    """
+    try:
+        faceTracker = FaceTracker()
+        while True:
+            slot = bus.takeCaptured()
+            if slot is None:
+                break
+            faceTracker.update(bus.frame(slot))
+            bus.setFaceRects(slot,
+                             [face.faceRect for face in faceTracker.faces])
+            bus.submitDetected(slot)
+    finally:
+        # The renderer must hear that this detector ended, even if it failed
+        bus.submitDetected(None)
+
+def runRenderer(bus, outputFilename=None, fps=30.0, fourcc='MJPG'):
+    """ Swap faces, filter and write out the frames, in order """
+    filterChain = filters.FilterChain([
+        filters.StrokeEdgesFilter(), filters.BGRProviaCurveFilter()])
+    videoWriter = None
+    numFrames = 0
+    latency = 0.0
+    startTime = time.time()
+    try:
+        while True:
+            slot = bus.takeDetected()
+            if slot is None:
+                break
+            frame = bus.frame(slot)
+            rects.swapRects(frame, frame, bus.getFaceRects(slot))
+            filterChain.apply(frame, frame)
+            if outputFilename is not None:
+                if videoWriter is None:
+                    size = (frame.shape[1], frame.shape[0])
+                    videoWriter = cv2.VideoWriter(
+                        outputFilename, cv2.VideoWriter_fourcc(*fourcc),
+                        fps, size)
+                videoWriter.write(frame)
+            latency += time.time() - float(bus.record(slot)['timestamp'])
+            bus.releaseSlot(slot)
+            numFrames += 1
+    finally:
+        if videoWriter is not None:
+            videoWriter.release()
+    seconds = time.time() - startTime
+    print("[FRAMEBUS] {} frames in {:.1f} s: {:.1f} frames/s, "
+          "{:.1f} ms mean latency".format(
+              numFrames, seconds, numFrames / max(seconds, 1e-9),
+              1000.0 * latency / max(1, numFrames)))
+
+def run(filename, outputFilename=None, numDetectors=2, numSlots=8,
+        maxFrames=None):
+    """ Run capture, detector and render processes over a file
+
+    Returns 0 on success. If the file can't be read, or a process fails,
+    the other processes are terminated and 1 is returned.
+    """
+    capture = framestore.openCapture(filename)
+    success, frame = capture.read()
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    capture.release()
+    if not success:
+        print("[FRAMEBUS] Could not read", filename)
+        return 1
+
+    bus = FrameBus(frame.shape, frame.dtype, numSlots,
+                   numDetectors=numDetectors)
+    processes = [multiprocessing.Process(
+        target=runCapture, args=(bus, filename, maxFrames), name='capture')]
+    for i in range(numDetectors):
+        processes.append(multiprocessing.Process(
+            target=runDetector, args=(bus,), name='detector{}'.format(i)))
+    processes.append(multiprocessing.Process(
+        target=runRenderer, args=(bus, outputFilename, fps), name='renderer'))
+    failedProcess = None
+    try:
+        for process in processes:
+            process.start()
+        # A failed process may leave the others waiting on it forever
+        while failedProcess is None and \
+                any(process.is_alive() for process in processes):
+            multiprocessing.connection.wait(
+                [process.sentinel for process in processes
+                 if process.is_alive()], 1.0)
+            for process in processes:
+                if process.exitcode:
+                    failedProcess = process
+                    break
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            if process.pid is not None:
+                process.join()
+        bus.close()
+        bus.unlink()
+
+    if failedProcess is not None:
+        print("[FRAMEBUS] The {} process failed with exit code {}".format(
+            failedProcess.name, failedProcess.exitcode))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run capture, detection and rendering in separate '
+                    'processes over a shared memory frame bus')
+    parser.add_argument('input', help='a video file or raw frame store')
+    parser.add_argument('--output', help='write the frames to a video file')
+    parser.add_argument('--detectors', type=int, default=2)
+    parser.add_argument('--slots', type=int, default=8)
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+    sys.exit(run(args.input, args.output, args.detectors, args.slots,
+                 args.max_frames))
@@ -0,0 +1,281 @@
+""" A raw frame store: uncompressed frames in a memory-mapped file
+
+A store is a fixed-size header followed by one record per frame, each
+holding the frame's timestamp and its pixels. Nothing is encoded, so frames
+are written at the rate they can be copied and read back exactly as they
+were captured.
+
+FrameStoreWriter appends frames, growing the file as needed.
+FrameStoreCapture replays a store through the cv2.VideoCapture interface,
+copying frames into the caller's buffer or, without one, returning views
+into the mapped file.
+"""
+
+import os
+import time
+
+import cv2
+import numpy
+
+
+FILE_EXTENSION = '.frames'
+
+MAGIC = b'CAMEOFRM'
+VERSION = 1
+
+HEADER_DTYPE = numpy.dtype([
+    ('magic', 'S8'), ('version', '<u4'), ('height', '<u4'), ('width', '<u4'),
+    ('channels', '<u4'), ('dtype', 'S8'), ('count', '<u8'),
+    ('reserved', 'u1', 24)])
+HEADER_SIZE = HEADER_DTYPE.itemsize
+
+
+def createRecordDtype(height, width, channels, dtype=numpy.uint8):
+    """ Return the dtype of one frame record: a timestamp, then the pixels """
+    if channels == 1:
+        frameShape = (height, width)
+    else:
+        frameShape = (height, width, channels)
+    return numpy.dtype([('timestamp', '<f8'),
+                        ('frame', numpy.dtype(dtype), frameShape)])
+
+def isFrameStore(filename):
+    return os.path.splitext(filename)[1].lower() == FILE_EXTENSION
+
+def openCapture(source):
+    """ Return a FrameStoreCapture for a store, or else a cv2.VideoCapture """
+    if isinstance(source, str) and isFrameStore(source):
+        return FrameStoreCapture(source)
+    return cv2.VideoCapture(source)
+
+
+class FrameStoreWriter(object):
+    """ Appends frames to a raw frame store
+
+    The frame size and type are taken from the first frame. The file grows
+    in chunks, which double in size up to maxGrowBy frames, and is trimmed
+    to its records when closed. The header's frame count is updated after
+    every frame, so a store that was never closed can still be read.
+    """
+
+    def __init__(self, filename, growBy=16, maxGrowBy=1024):
+        self.growBy = growBy
+        self.maxGrowBy = maxGrowBy
+
+        self._filename = filename
+        self._header = None
+        self._records = None
+        self._recordDtype = None
+        self._count = 0
+        self._capacity = 0
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def frameCount(self):
+        return self._count
+
+    def append(self, timestamp, frame):
+        """ Copy a frame into the next record """
+        if self._records is None:
+            self._create(frame)
+        elif frame.shape != self._recordDtype['frame'].shape or \
+                frame.dtype != self._recordDtype['frame'].base:
+            raise ValueError('frame of shape {} and type {} does not match '
+                             'the store'.format(frame.shape, frame.dtype))
+
+        if self._count == self._capacity:
+            self._grow()
+        self._records['timestamp'][self._count] = timestamp
+        self._records['frame'][self._count] = frame
+        self._count += 1
+        self._header['count'] = self._count
+
+    def write(self, frame):
+        """ Append a frame, timestamped now, as cv2.VideoWriter.write would """
+        self.append(time.time(), frame)
+
+    def flush(self):
+        if self._records is not None:
+            self._records.flush()
+            self._header.flush()
+
+    def close(self):
+        """ Flush the records and trim the file to them """
+        if self._records is None:
+            return
+        self.flush()
+        self._records = None
+        self._header = None
+        with open(self._filename, 'r+b') as storeFile:
+            storeFile.truncate(HEADER_SIZE +
+                               self._count * self._recordDtype.itemsize)
+
+    release = close
+
+    def _create(self, frame):
+        height, width = frame.shape[:2]
+        channels = 1 if frame.ndim == 2 else frame.shape[2]
+        self._recordDtype = createRecordDtype(height, width, channels,
+                                              frame.dtype)
+
+        with open(self._filename, 'wb') as storeFile:
+            storeFile.truncate(HEADER_SIZE)
+        self._header = numpy.memmap(self._filename, HEADER_DTYPE, 'r+',
+                                    shape=(1,))
+        self._header['magic'] = MAGIC
+        self._header['version'] = VERSION
+        self._header['height'] = height
+        self._header['width'] = width
+        self._header['channels'] = channels
+        self._header['dtype'] = frame.dtype.str.encode('ascii')
+        self._header['count'] = 0
+        self._grow()
+
+    def _grow(self):
+        """ Extend the file and remap the records """
+        if self._records is not None:
+            self._records.flush()
+        self._capacity += min(max(self.growBy, self._capacity),
+                              self.maxGrowBy)
+        with open(self._filename, 'r+b') as storeFile:
+            storeFile.truncate(HEADER_SIZE +
+                               self._capacity * self._recordDtype.itemsize)
+        self._records = numpy.memmap(self._filename, self._recordDtype, 'r+',
+                                     offset=HEADER_SIZE,
+                                     shape=(self._capacity,))
+
+
+class FrameStoreCapture(object):
+    """ Replays a raw frame store like a cv2.VideoCapture
+
+    Like cv2.VideoCapture, read() and retrieve() copy the frame into the
+    given image, or into a new array if its shape or type doesn't match.
+    Without an image they return a view into the mapped file instead of a
+    copy. The file is mapped copy-on-write, so a view may be modified in
+    place without changing the store, but the pages that are modified take
+    up private memory until the capture is released; a caller that modifies
+    every frame should pass a buffer of its own.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._header = None
+        self._records = None
+        self._position = 0
+        self._isGrabbed = False
+        self._open()
+
+    @property
+    def frameCount(self):
+        if self._records is None:
+            return 0
+        return len(self._records)
+
+    @property
+    def frames(self):
+        """ All the frames, as an (N, H, W[, C]) stack of copy-on-write views """
+        if self._records is None:
+            return None
+        return self._records['frame']
+
+    @property
+    def timestamps(self):
+        """ The index of frame timestamps, in seconds since the epoch """
+        if self._records is None:
+            return numpy.empty(0)
+        return self._records['timestamp']
+
+    def isOpened(self):
+        return self._records is not None
+
+    def grab(self):
+        if self._isGrabbed:
+            self._position += 1
+        self._isGrabbed = self._position < self.frameCount
+        return self._isGrabbed
+
+    def retrieve(self, image=None, flag=0):
+        if not self._isGrabbed:
+            return False, None
+        frame = self._records['frame'][self._position].view(numpy.ndarray)
+        if image is None:
+            return True, frame
+        if image.shape != frame.shape or image.dtype != frame.dtype:
+            return True, frame.copy()
+        image[...] = frame
+        return True, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, propId):
+        count = self.frameCount
+        if propId == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self._header['width']) if count else 0.0
+        elif propId == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self._header['height']) if count else 0.0
+        elif propId == cv2.CAP_PROP_FRAME_COUNT:
+            return float(count)
+        elif propId == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._nextPosition())
+        elif propId == cv2.CAP_PROP_POS_MSEC:
+            if count == 0:
+                return 0.0
+            position = min(self._position, count - 1)
+            timestamps = self.timestamps
+            return 1000.0 * float(timestamps[position] - timestamps[0])
+        elif propId == cv2.CAP_PROP_FPS:
+            if count < 2:
+                return 0.0
+            timestamps = self.timestamps
+            duration = float(timestamps[-1] - timestamps[0])
+            if duration <= 0.0:
+                return 0.0
+            return (count - 1) / duration
+        return 0.0
+
+    def set(self, propId, value):
+        """ Seek, for CAP_PROP_POS_FRAMES only """
+        if propId != cv2.CAP_PROP_POS_FRAMES or self._records is None:
+            return False
+        self._position = max(0, min(int(value), self.frameCount))
+        self._isGrabbed = False
+        return True
+
+    def release(self):
+        self._records = None
+        self._header = None
+        self._isGrabbed = False
+
+    def _nextPosition(self):
+        """ The index of the frame the next grab() will get """
+        if self._isGrabbed:
+            return self._position + 1
+        return self._position
+
+    def _open(self):
+        if not os.path.isfile(self._filename) or \
+                os.path.getsize(self._filename) < HEADER_SIZE:
+            return
+        header = numpy.fromfile(self._filename, HEADER_DTYPE, 1)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            return
+        recordDtype = createRecordDtype(
+            int(header['height']), int(header['width']),
+            int(header['channels']), header['dtype'].decode('ascii'))
+
+        # Only complete records count, in case the writer was interrupted
+        fileCount = (os.path.getsize(self._filename) - HEADER_SIZE) // \
+            recordDtype.itemsize
+        count = min(int(header['count']), fileCount)
+        self._header = header
+        if count == 0:
+            self._records = numpy.empty(0, recordDtype)
+        else:
+            self._records = numpy.memmap(self._filename, recordDtype, 'c',
+                                         offset=HEADER_SIZE, shape=(count,))
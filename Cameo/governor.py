@@ -0,0 +1,155 @@
+import logging
+import time
+
+from profiling import RingBuffer
+
+logger = logging.getLogger(__name__)
+
+
+# Quality levels, from full quality to cheapest. Each sets the FaceTracker's
+# detection interval, detection width and cascade scale factor, and the
+# StrokeEdgesFilter's kernel sizes (a blurKsize below 3 skips the blur).
+DEFAULT_LEVELS = (
+    {'detectionInterval': 1, 'detectionWidth': None, 'scaleFactor': 1.2,
+     'blurKsize': 7, 'edgeKsize': 5},
+    {'detectionInterval': 2, 'detectionWidth': None, 'scaleFactor': 1.2,
+     'blurKsize': 7, 'edgeKsize': 5},
+    {'detectionInterval': 3, 'detectionWidth': 640, 'scaleFactor': 1.2,
+     'blurKsize': 7, 'edgeKsize': 5},
+    {'detectionInterval': 5, 'detectionWidth': 480, 'scaleFactor': 1.3,
+     'blurKsize': 5, 'edgeKsize': 5},
+    {'detectionInterval': 5, 'detectionWidth': 320, 'scaleFactor': 1.3,
+     'blurKsize': 5, 'edgeKsize': 3},
+    {'detectionInterval': 8, 'detectionWidth': 320, 'scaleFactor': 1.4,
+     'blurKsize': 3, 'edgeKsize': 3},
+    {'detectionInterval': 10, 'detectionWidth': 240, 'scaleFactor': 1.5,
+     'blurKsize': 1, 'edgeKsize': 3},
+)
+
+
+class QualityGovernor(object):
+    """ Trades quality for speed to keep the frame loop within a budget
+
+    The budget is the time per frame, 1 / targetFps, unless a latency
+    budget in seconds is given. Only the time between startFrame() and
+    endFrame() counts, so time spent waiting for the camera doesn't.
+
+    Quality drops a level as soon as the mean of the last few frames is over
+    budget, so load spikes cost quality rather than frames. It rises a level
+    only when a much longer window has stayed under upgradeRatio of the
+    budget, and never within upgradeCooldown frames of a change. The gap
+    between the two thresholds keeps the governor from oscillating.
+
+    A level that has to be left again within upgradeCooldown frames of
+    rising to it is remembered as too slow: the wait before rising to it
+    doubles with each such failure, up to maxUpgradeCooldown frames, and
+    goes back to upgradeCooldown once the level holds.
+    """
+
+    def __init__(self, targetFps=30.0, faceTracker=None,
+            strokeEdgesFilter=None, levels=DEFAULT_LEVELS,
+            latencyBudget=None, shortWindow=5, longWindow=60,
+            upgradeRatio=0.7, degradeCooldown=5, upgradeCooldown=60,
+            maxUpgradeCooldown=1800):
+        self.faceTracker = faceTracker
+        self.strokeEdgesFilter = strokeEdgesFilter
+        self.levels = levels
+        self.budget = latencyBudget or 1.0 / targetFps
+        self.upgradeRatio = upgradeRatio
+        self.degradeCooldown = degradeCooldown
+        self.upgradeCooldown = upgradeCooldown
+        self.maxUpgradeCooldown = maxUpgradeCooldown
+        self.isEnabled = True
+
+        self._shortWindow = shortWindow
+        self._longWindow = longWindow
+        self._frameTimes = RingBuffer(longWindow)
+        self._frameStartTime = None
+        self._framesSinceChange = 0
+        # The frames to wait before rising to each level, and whether the
+        # current level was risen to and has yet to hold
+        self._upgradeCooldowns = [upgradeCooldown] * len(levels)
+        self._isUpgradePending = False
+        self._level = 0
+        self.setLevel(0)
+
+    @property
+    def level(self):
+        """ The current level, 0 being full quality """
+        return self._level
+
+    @property
+    def decisions(self):
+        """ The current level, its settings and the recent frame times """
+        decisions = dict(self.levels[self._level])
+        decisions['level'] = self._level
+        decisions['budgetMs'] = 1000.0 * self.budget
+        if self._level > 0:
+            decisions['upgradeCooldown'] = \
+                self._upgradeCooldowns[self._level - 1]
+        frameTimes = self._frameTimes.values
+        if len(frameTimes) > 0:
+            decisions['meanMs'] = 1000.0 * float(
+                frameTimes[-self._shortWindow:].mean())
+        return decisions
+
+    def startFrame(self):
+        self._frameStartTime = time.time()
+
+    def endFrame(self):
+        """ Record the frame's time since startFrame() and adjust quality """
+        if self._frameStartTime is None:
+            return False
+        frameTime = time.time() - self._frameStartTime
+        self._frameStartTime = None
+        return self.addFrameTime(frameTime)
+
+    def addFrameTime(self, frameTime):
+        """ Record a frame's processing time; return True if quality changed """
+        self._frameTimes.append(frameTime)
+        self._framesSinceChange += 1
+        if not self.isEnabled:
+            return False
+
+        if self._isUpgradePending and \
+                self._framesSinceChange >= self.upgradeCooldown:
+            # The level held, so rising to it again needn't wait longer
+            self._upgradeCooldowns[self._level] = self.upgradeCooldown
+            self._isUpgradePending = False
+
+        frameTimes = self._frameTimes.values
+        if self._level + 1 < len(self.levels) and \
+                self._framesSinceChange >= self.degradeCooldown and \
+                len(frameTimes) >= self._shortWindow and \
+                frameTimes[-self._shortWindow:].mean() > self.budget:
+            if self._isUpgradePending:
+                self._upgradeCooldowns[self._level] = min(
+                    2 * self._upgradeCooldowns[self._level],
+                    self.maxUpgradeCooldown)
+            self.setLevel(self._level + 1)
+            return True
+        if self._level > 0 and \
+                self._framesSinceChange >= \
+                    self._upgradeCooldowns[self._level - 1] and \
+                len(frameTimes) >= self._longWindow and \
+                frameTimes.mean() < self.upgradeRatio * self.budget:
+            self.setLevel(self._level - 1)
+            self._isUpgradePending = True
+            return True
+        return False
+
+    def setLevel(self, level):
+        """ Apply a level's settings to the tracker and filter """
+        self._level = max(0, min(level, len(self.levels) - 1))
+        self._framesSinceChange = 0
+        self._isUpgradePending = False
+        settings = self.levels[self._level]
+        if self.faceTracker is not None:
+            for name in ('detectionInterval', 'detectionWidth', 'scaleFactor'):
+                if name in settings:
+                    setattr(self.faceTracker, name, settings[name])
+        if self.strokeEdgesFilter is not None:
+            for name in ('blurKsize', 'edgeKsize'):
+                if name in settings:
+                    setattr(self.strokeEdgesFilter, name, settings[name])
+        logger.info("Quality level %d: %s", self._level, self.decisions)
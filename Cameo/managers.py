@@ -1,25 +1,335 @@
 #!/usr/bin/env python
 
+import collections
 import cv2
+import logging
 import numpy
+import threading
 import time
 
+from framestore import FrameStoreWriter
+from profiling import FrameProfiler
+
+# Per-frame messages are logged at DEBUG level, so they cost next to
+# nothing unless that level is enabled
+logger = logging.getLogger(__name__)
+
+class AsyncCapture(object):
+    """ Grabs frames from a capture on a background thread
+
+    Frames are decoded into a preallocated ring of buffers. The consumer
+    takes a ready buffer with takeFrame() and hands it back with
+    releaseFrame() once it is done with it.
+
+    With the 'dropOldest' policy the consumer always gets the newest frame and
+    the producer overwrites the oldest unconsumed frame when the ring is full.
+    With the 'block' policy every frame is delivered in order and the producer
+    waits for a free buffer, which suits file sources.
+
+    Frames are retrieved from the capture's channel, which only the producer
+    thread reads. Changing it affects the frames decoded afterwards.
+    """
+
+    DROP_OLDEST = 'dropOldest'
+    BLOCK = 'block'
+
+    def __init__(self, capture, numBuffers=3, policy=DROP_OLDEST):
+        assert policy in (AsyncCapture.DROP_OLDEST, AsyncCapture.BLOCK), \
+            'unknown capture policy: {}'.format(policy)
+        # The consumer holds one buffer, so at least two more are needed
+        assert numBuffers >= 3, 'numBuffers must be at least 3'
+
+        self.policy = policy
+        self.channel = 0
+
+        self._capture = capture
+        self._buffers = [None] * numBuffers
+        self._freeSlots = collections.deque(range(numBuffers))
+        self._readySlots = collections.deque()
+        self._condition = threading.Condition()
+        self._isRunning = False
+        self._isFinished = False
+        self._thread = None
+
+        self._framesCaptured = 0
+        self._framesDropped = 0
+
+    @property
+    def framesCaptured(self):
+        return self._framesCaptured
+
+    @property
+    def framesDropped(self):
+        return self._framesDropped
+
+    @property
+    def isFinished(self):
+        """ True once the source has no more frames and none are ready """
+        with self._condition:
+            return self._isFinished and not self._readySlots
+
+    def start(self):
+        """ Start the producer thread """
+        if self._thread is not None:
+            return
+        self._isRunning = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the producer thread and wait for it to finish """
+        with self._condition:
+            self._isRunning = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def takeFrame(self, timeout=None):
+        """ Return (slot, frame) for a ready frame, or (None, None) """
+        with self._condition:
+            while not self._readySlots:
+                if self._isFinished or not self._isRunning:
+                    return None, None
+                if not self._condition.wait(timeout) and timeout is not None:
+                    return None, None
+            if self.policy == AsyncCapture.BLOCK:
+                slot = self._readySlots.popleft()
+            else:
+                slot = self._readySlots.pop()
+                # Anything older than the newest frame is stale
+                self._framesDropped += len(self._readySlots)
+                self._freeSlots.extend(self._readySlots)
+                self._readySlots.clear()
+                self._condition.notify_all()
+            return slot, self._buffers[slot]
+
+    def releaseFrame(self, slot):
+        """ Return a buffer obtained from takeFrame() to the ring """
+        if slot is None:
+            return
+        with self._condition:
+            self._freeSlots.append(slot)
+            self._condition.notify_all()
+
+    def _acquireFreeSlot(self):
+        with self._condition:
+            while not self._freeSlots:
+                if not self._isRunning:
+                    return None
+                if self.policy == AsyncCapture.DROP_OLDEST and \
+                        self._readySlots:
+                    self._framesDropped += 1
+                    return self._readySlots.popleft()
+                self._condition.wait()
+            return self._freeSlots.popleft()
+
+    def _run(self):
+        while self._isRunning:
+            slot = self._acquireFreeSlot()
+            if slot is None:
+                break
+            # Decode straight into the slot's buffer when it already exists
+            channel = self.channel
+            if channel == 0:
+                success, frame = self._capture.read(self._buffers[slot])
+            else:
+                success = self._capture.grab()
+                frame = None
+                if success:
+                    success, frame = self._capture.retrieve(
+                        self._buffers[slot], channel)
+            with self._condition:
+                if not success or frame is None:
+                    self._freeSlots.append(slot)
+                    self._isFinished = True
+                    self._condition.notify_all()
+                    break
+                self._buffers[slot] = frame
+                self._readySlots.append(slot)
+                self._framesCaptured += 1
+                self._condition.notify_all()
+        with self._condition:
+            self._isFinished = True
+            self._condition.notify_all()
+
+
+class AsyncWriter(object):
+    """ Runs write jobs (image and video writes) on a background thread
+
+    Jobs wait in a queue of at most maxQueueSize entries. When the queue is
+    full the 'drop' policy discards the new job, the 'block' policy waits for
+    room and the 'spill' policy lets the queue grow past its bound by up to
+    maxSpillSize more jobs, then waits for room as 'block' does, so a writer
+    that can't keep up holds a bounded number of frames. Jobs are always run
+    in the order they were submitted. A job that raises is logged
+    and counted, and the jobs after it still run.
+    """
+
+    DROP = 'drop'
+    BLOCK = 'block'
+    SPILL = 'spill'
+
+    def __init__(self, maxQueueSize=32, policy=BLOCK, maxSpillSize=32):
+        assert policy in (AsyncWriter.DROP, AsyncWriter.BLOCK,
+                          AsyncWriter.SPILL), \
+            'unknown write policy: {}'.format(policy)
+
+        self.maxQueueSize = maxQueueSize
+        self.maxSpillSize = maxSpillSize
+        self.policy = policy
+
+        self._jobs = collections.deque()
+        self._condition = threading.Condition()
+        self._isRunning = True
+        self._isWriting = False
+
+        self._jobsWritten = 0
+        self._jobsDropped = 0
+        self._jobsSpilled = 0
+        self._jobsFailed = 0
+        self._maxQueueDepth = 0
+        self._totalWriteTime = 0.0
+        self._lastWriteTime = 0.0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def stats(self):
+        """ A dict of queue depth, job counts and write latencies (seconds) """
+        with self._condition:
+            meanWriteTime = 0.0
+            if self._jobsWritten > 0:
+                meanWriteTime = self._totalWriteTime / self._jobsWritten
+            return {'queueDepth': len(self._jobs),
+                    'maxQueueDepth': self._maxQueueDepth,
+                    'jobsWritten': self._jobsWritten,
+                    'jobsDropped': self._jobsDropped,
+                    'jobsSpilled': self._jobsSpilled,
+                    'jobsFailed': self._jobsFailed,
+                    'lastWriteLatency': self._lastWriteTime,
+                    'meanWriteLatency': meanWriteTime}
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func(*args); return False if the job was dropped
+
+        With force=True the job is queued whatever the policy, as control
+        jobs such as releasing a writer must never be lost.
+        """
+        with self._condition:
+            assert self._isRunning, 'submit() after stop()'
+            if len(self._jobs) >= self.maxQueueSize and \
+                    not kwargs.get('force', False):
+                if self.policy == AsyncWriter.DROP:
+                    self._jobsDropped += 1
+                    return False
+                elif self.policy == AsyncWriter.BLOCK:
+                    while len(self._jobs) >= self.maxQueueSize:
+                        self._condition.wait()
+                else:
+                    maxSize = self.maxQueueSize + self.maxSpillSize
+                    while len(self._jobs) >= maxSize:
+                        self._condition.wait()
+                    if len(self._jobs) >= self.maxQueueSize:
+                        self._jobsSpilled += 1
+            self._jobs.append((func, args))
+            self._maxQueueDepth = max(self._maxQueueDepth, len(self._jobs))
+            self._condition.notify_all()
+            return True
+
+    def flush(self):
+        """ Wait until every queued job has been written """
+        with self._condition:
+            while self._jobs or self._isWriting:
+                self._condition.wait()
+
+    def stop(self):
+        """ Write any queued jobs, then stop the writer thread """
+        with self._condition:
+            self._isRunning = False
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs and self._isRunning:
+                    self._condition.wait()
+                if not self._jobs:
+                    return
+                func, args = self._jobs.popleft()
+                self._isWriting = True
+                self._condition.notify_all()
+
+            startTime = time.time()
+            isFailed = False
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Write job %r failed", func)
+                isFailed = True
+            writeTime = time.time() - startTime
+
+            with self._condition:
+                self._isWriting = False
+                if isFailed:
+                    self._jobsFailed += 1
+                else:
+                    self._jobsWritten += 1
+                    self._totalWriteTime += writeTime
+                    self._lastWriteTime = writeTime
+                self._condition.notify_all()
+
+
 class CaptureManager(object):
-    def __init__(self, capture, previewWindowManager=None, shouldMirrorPreview=False):
+    def __init__(self, capture, previewWindowManager=None, shouldMirrorPreview=False,
+            shouldCaptureAsync=False, numCaptureBuffers=3,
+            capturePolicy=AsyncCapture.DROP_OLDEST,
+            shouldWriteAsync=False, writeQueueSize=32,
+            writePolicy=AsyncWriter.BLOCK, shouldProfile=False,
+            metricsFilename=None, metricsInterval=30):
         self.previewWindowManager = previewWindowManager
         self.shouldMirrorPreview = shouldMirrorPreview
 
+        # Per-stage timings. Callers time their own stages with
+        # profiler.start(stage) and profiler.stop(stage).
+        self.profiler = FrameProfiler(isEnabled=shouldProfile)
+        self.shouldDrawProfile = False
+        self.metricsInterval = metricsInterval
+        self._metricsFile = None
+        if metricsFilename is not None:
+            self.profiler.isEnabled = True
+            self._metricsFile = open(metricsFilename, 'a')
+
         self._capture = capture
+        self._asyncCapture = None
+        self._asyncSlot = None
+        if shouldCaptureAsync and capture is not None:
+            self._asyncCapture = AsyncCapture(capture, numCaptureBuffers,
+                                              capturePolicy)
+            self._asyncCapture.start()
         self._channel = 0
         self._enteredFrame = False
         self._frame = None
+        self._retrieveBuffer = None
+        self._frameToWrite = None
+        self._previewFrame = None
         self._imageFilename = None
         self._videoFilename = None
         self._videoEncoding = None
         self._videoWriter = None
+        self._framesFilename = None
+        self._frameStoreWriter = None
+        self._frameTimestamp = None
+        self._asyncWriter = None
+        if shouldWriteAsync:
+            self._asyncWriter = AsyncWriter(writeQueueSize, writePolicy)
 
         self._startTime = None
-        self._framesElapsed = long(0)
+        self._framesElapsed = 0
         self._fpsEstimate = None
 
     @property
@@ -30,14 +340,41 @@ class CaptureManager(object):
     def channel(self,value):
         if self._channel != value:
             self._channel = value
-            self._frame = None
+            if self._asyncCapture is not None:
+                # Only the producer thread may use the capture, so the
+                # current frame is kept and later frames use the channel
+                self._asyncCapture.channel = value
+            else:
+                self._frame = None
 
     @property
     def frame(self):
-        if self._enteredFrame and self._frame is None:
-            _ , self._frame = self._capture.retrieve()
+        if self._enteredFrame and self._frame is None and \
+                self._asyncCapture is None:
+            self.profiler.start('retrieve')
+            # Retrieve into the last frame's buffer, which is free once
+            # the frame is exited, rather than allocating every frame
+            _ , self._frame = self._capture.retrieve(self._retrieveBuffer,
+                                                     self._channel)
+            if self._frame is not None:
+                self._retrieveBuffer = self._frame
+            self.profiler.stop('retrieve')
         return self._frame
 
+    @property
+    def framesDropped(self):
+        """ Frames the asynchronous capture discarded unseen """
+        if self._asyncCapture is None:
+            return 0
+        return self._asyncCapture.framesDropped
+
+    @property
+    def writerStats(self):
+        """ Statistics of the asynchronous writer, or None if writes are inline """
+        if self._asyncWriter is None:
+            return None
+        return self._asyncWriter.stats
+
     @property
     def isWritingImage(self):
         return self._imageFilename is not None
@@ -46,6 +383,10 @@ class CaptureManager(object):
     def isWritingVideo(self):
         return self._videoFilename is not None
 
+    @property
+    def isWritingFrames(self):
+        return self._framesFilename is not None
+
     def enterFrame(self):
         """ Capture the next frame, if any """
 
@@ -53,9 +394,14 @@ class CaptureManager(object):
         assert not self._enteredFrame, \
             'previous enterFrame() had no matching exitFrame()'
 
-        if self._capture is not None:
-            print("[CM] I have a captureObject. Grabbing Frame...")
+        self.profiler.start('grab')
+        self._frameTimestamp = time.time()
+        if self._asyncCapture is not None:
+            self._asyncSlot, self._frame = self._asyncCapture.takeFrame()
+            self._enteredFrame = self._frame is not None
+        elif self._capture is not None:
             self._enteredFrame = self._capture.grab()
+        self.profiler.stop('grab')
 
     def exitFrame(self):
         """ Draw to the window, write to files, release the frame """
@@ -63,47 +409,94 @@ class CaptureManager(object):
         # Check whether any grabbed frame is retrievable
         # the getter may retrieve and cache the frame
         if self.frame is None:
-            print("[CM] I don't have a frame to work on!")
+            logger.debug("No frame to exit")
+            self._releaseAsyncFrame()
             self._enteredFrame = False
             return
 
         # Update the fps estimate and related variables
-        print("[CM] Updating fps estimate")
         if self._framesElapsed == 0:
             self._startTime = time.time()
         else:
             timeElapsed = time.time() - self._startTime
             self._fpsEstimate = self._framesElapsed / timeElapsed
 
-        print("[CM] Frames elapsed =",self._framesElapsed)
         self._framesElapsed += 1
 
-        # Draw to the window if one exists
-        if self.previewWindowManager is not None:
-            print("[CM] I have a window manager")
-            if self.shouldMirrorPreview: # Do we need to flip image?
-                print("[CM] I have to mirror my images")
-                mirroredFrame = numpy.fliplr(self._frame).copy()
-                self.previewWindowManager.show(mirroredFrame)
-            else:
-                print("[CM] I don't have to mirror my images")
-                self.previewWindowManager.show(self._frame)
+        # Write before drawing to the window, as drawing may add an overlay
+        self.profiler.start('write')
 
         # Write to the image file, if any
         if self.isWritingImage:
-            print("[CM] I am writing frame number",self._framesElapsed-1,"to image file", self._imageFilename)
-            cv2.imwrite(self._imageFilename, self._frame)
-            print("[CM] Setting the filename handle to 'None'")
+            logger.debug("Writing frame %d to %s", self._framesElapsed - 1,
+                         self._imageFilename)
+            self._submitWrite(cv2.imwrite, self._imageFilename)
             self._imageFilename = None # ensure we don't overwrite the current image
 
         # Write to video if any (carries out an internal check in the call)
         self._writeVideoFrame()
+        if self.isWritingFrames:
+            self._submitWrite(self._frameStoreWriter.append,
+                              self._frameTimestamp)
+        self.profiler.stop('write')
+
+        # Draw to the window if one exists and can be seen
+        if self.previewWindowManager is not None and \
+                getattr(self.previewWindowManager, 'isWindowVisible', True):
+            self.profiler.start('show')
+            if self.shouldMirrorPreview: # Do we need to flip image?
+                previewFrame = self._mirrorPreviewFrame()
+            else:
+                previewFrame = self._frame
+            if self.shouldDrawProfile:
+                self.profiler.drawOverlay(previewFrame)
+            self.previewWindowManager.show(previewFrame)
+            self.profiler.stop('show')
+
+        self.profiler.markFrame()
+        if self._metricsFile is not None and \
+                self._framesElapsed % self.metricsInterval == 0:
+            self.profiler.writeStats(self._metricsFile)
 
         # Release the frame
-        print("[CM] Releasing the frame")
+        self._releaseAsyncFrame()
+        self._frameToWrite = None
         self._frame = None
         self._enteredFrame = False
 
+    def _mirrorPreviewFrame(self):
+        """ Flip the frame into the preview buffer, which is reused """
+        if self._previewFrame is None or \
+                self._previewFrame.shape != self._frame.shape or \
+                self._previewFrame.dtype != self._frame.dtype:
+            self._previewFrame = numpy.empty_like(self._frame)
+        cv2.flip(self._frame, 1, self._previewFrame)
+        return self._previewFrame
+
+    def release(self):
+        """ Stop background capture and writing and release the capture """
+        if self._metricsFile is not None:
+            self._metricsFile.close()
+            self._metricsFile = None
+        if self.isWritingVideo:
+            self.stopWritingVideo()
+        if self.isWritingFrames:
+            self.stopWritingFrames()
+        if self._asyncWriter is not None:
+            self._asyncWriter.stop()
+            self._asyncWriter = None
+        if self._asyncCapture is not None:
+            self._asyncCapture.stop()
+            self._asyncCapture = None
+            self._asyncSlot = None
+        if self._capture is not None:
+            self._capture.release()
+
+    def _releaseAsyncFrame(self):
+        if self._asyncCapture is not None:
+            self._asyncCapture.releaseFrame(self._asyncSlot)
+        self._asyncSlot = None
+
     def writeImage(self, filename):
         """ Write the next exited frame to an image file """
         self._imageFilename = filename
@@ -114,37 +507,78 @@ class CaptureManager(object):
         self._videoEncoding = encoding
 
     def stopWritingVideo(self):
-        """ Start writing exited frames to a video file """
+        """ Stop writing exited frames to a video file """
+        if self._videoWriter is not None:
+            # Release after any frames still queued for the writer
+            self._submitWrite(self._videoWriter.release, copyFrame=False,
+                              force=True)
         self._videoFilename = None
         self._videoEncoding = None
         self._videoWriter = None
 
+    def startWritingFrames(self, filename):
+        """ Start writing exited frames, unencoded, to a raw frame store
+
+        The store can be replayed with framestore.FrameStoreCapture.
+        """
+        self._framesFilename = filename
+        self._frameStoreWriter = FrameStoreWriter(filename)
+
+    def stopWritingFrames(self):
+        """ Stop writing exited frames to a raw frame store """
+        if self._frameStoreWriter is not None:
+            self._submitWrite(self._frameStoreWriter.close, copyFrame=False,
+                              force=True)
+        self._framesFilename = None
+        self._frameStoreWriter = None
+
+    def _submitWrite(self, func, *args, **kwargs):
+        """ Call func(*args, frame), on the writer thread if there is one
+
+        Only asynchronous writes need their own copy of the frame, since the
+        frame buffer is reused once the frame is exited. The copy is shared by
+        every write of the same frame. With force=True the job is queued even
+        if the write policy would drop it.
+        """
+        if kwargs.get('copyFrame', True):
+            if self._asyncWriter is None:
+                args += (self._frame,)
+            else:
+                if self._frameToWrite is None:
+                    self._frameToWrite = self._frame.copy()
+                args += (self._frameToWrite,)
+        if self._asyncWriter is None:
+            func(*args)
+        else:
+            self._asyncWriter.submit(func, *args,
+                                     force=kwargs.get('force', False))
+
     def _writeVideoFrame(self):
 
         if not self.isWritingVideo:
-            print("[CM] No filename supplied for video frames")
             return
 
         if self._videoWriter is None:
             fps = self._capture.get(cv2.CAP_PROP_FPS)
             if fps == 0.0:
                 # The capture's FPS is unknown so use an estimate
-                print("[CM] Frame rate is unknown. Estimating...")
                 if self._framesElapsed < 20:
                     # Wait until more frames elapse so that the estimate is
                     # more stable
                     return
                 else:
                     fps = self._fpsEstimate
-                    print("[CM] Frame rate is",self._fpsEstimate)
+                    logger.debug("Estimated the frame rate as %.1f", fps)
 
             size = (int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
                 int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-            print("[CM] image size is", size)
+            logger.debug("Writing video of size %s to %s", size,
+                         self._videoFilename)
             self._videoWriter = cv2.VideoWriter(
                 self._videoFilename, self._videoEncoding,
                 fps, size)
-            self._videoWriter.write(self,_frame)
+
+        self._submitWrite(self._videoWriter.write)
 
 class WindowManager(object):
 
@@ -154,6 +588,7 @@ class WindowManager(object):
 
         self._windowName = windowName
         self._isWindowCreated = False
+        self._wasWindowVisible = False
 
     @property
     def isWindowCreated(self):
@@ -163,23 +598,56 @@ class WindowManager(object):
     def windowName(self):
         return self._windowName
 
+    @property
+    def isWindowVisible(self):
+        """ False if the window is known to be hidden, e.g. minimized """
+        if not self._isWindowCreated:
+            return False
+        # Backends that can't report visibility return -1
+        return self._getWindowVisibility() != 0
+
     def createWindow(self):
         cv2.namedWindow(self._windowName)
         self._isWindowCreated = True
+        self._wasWindowVisible = False
 
     def show(self, frame):
-        print("[WM] Showing frame in window")
         cv2.imshow(self._windowName, frame)
 
     def destroyWindow(self):
-        cv2.destroyWindow(self._windowName)
+        try:
+            cv2.destroyWindow(self._windowName)
+        except cv2.error:
+            # The user already closed it
+            pass
         self._isWindowCreated = False
+        self._wasWindowVisible = False
 
     def processEvents(self):
+        """ Handle key presses, and destroy the window if the user closed it
+
+        On GTK and Qt a closed window reports itself invisible while a
+        minimized one doesn't, so a window that was visible and no longer is
+        has been closed. Destroying it ends loops over isWindowCreated.
+        """
         keycode = cv2.waitKey(1)
+        if self._isWindowCreated:
+            visibility = self._getWindowVisibility()
+            if visibility >= 1:
+                self._wasWindowVisible = True
+            elif visibility == 0 and self._wasWindowVisible:
+                self.destroyWindow()
         if self.keypressCallback is not None and keycode != -1:
             # Discard any non-ASCII info encoded by GTK
             keycode &= 0xFF
             self.keypressCallback(keycode)
 
             # Augement this with mousecallback functionality later
+
+    def _getWindowVisibility(self):
+        """ 1 if visible, 0 if not, -1 if the backend can't tell """
+        try:
+            return cv2.getWindowProperty(self._windowName,
+                                         cv2.WND_PROP_VISIBLE)
+        except cv2.error:
+            return -1
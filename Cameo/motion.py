@@ -0,0 +1,220 @@
+import collections
+import copy
+
+import cv2
+import numpy
+
+
+def createTileBounds(length, tileSize):
+    """ Return the edges dividing length into tiles of about tileSize """
+    numTiles = max(1, int(round(float(length) / tileSize)))
+    return numpy.linspace(0, length, numTiles + 1).astype(int)
+
+def mergeTileRuns(tiles, xBounds, yBounds):
+    """ Return the set tiles of a grid as (x, y, w, h), merged into runs
+    along rows """
+    runRects = []
+    for row, columns in enumerate(tiles):
+        top, bottom = yBounds[row], yBounds[row + 1]
+        column = 0
+        while column < len(columns):
+            if not columns[column]:
+                column += 1
+                continue
+            start = column
+            while column < len(columns) and columns[column]:
+                column += 1
+            left, right = xBounds[start], xBounds[column]
+            runRects.append((int(left), int(top), int(right - left),
+                             int(bottom - top)))
+    return runRects
+
+def expandRect(rect, margin, width, height):
+    """ Grow an (x, y, w, h) rectangle by margin, clipped to the frame """
+    x, y, w, h = rect
+    left = max(0, x - margin)
+    top = max(0, y - margin)
+    right = min(width, x + w + margin)
+    bottom = min(height, y + h + margin)
+    return left, top, right - left, bottom - top
+
+
+class MotionGate(object):
+    """ Finds the tiles of a frame that changed, by cheap frame differencing
+
+    The frame is divided into a grid of tiles of about tileSize pixels and
+    shrunk to cellSize gray pixels per tile. A tile is dirty when any of its
+    pixels differs from the reference by more than threshold. The reference
+    of a tile is only updated when it is dirty, so slow changes add up
+    until they count. The frame is static when no tile is dirty.
+    """
+
+    def __init__(self, tileSize=64, cellSize=8, threshold=12):
+        self.tileSize = tileSize
+        self.cellSize = cellSize
+        self.threshold = threshold
+
+        self._frameShape = None
+        self._xBounds = None
+        self._yBounds = None
+        self._smallGray = None
+        self._reference = None
+        self._difference = None
+        self._dirtyTiles = None
+
+    @property
+    def isStatic(self):
+        """ True if no tile changed in the last update() """
+        return self._dirtyTiles is not None and not self._dirtyTiles.any()
+
+    @property
+    def dirtyFraction(self):
+        if self._dirtyTiles is None:
+            return 1.0
+        return float(self._dirtyTiles.mean())
+
+    @property
+    def dirtyRects(self):
+        """ The dirty tiles as (x, y, w, h), merged into runs along rows """
+        if self._dirtyTiles is None:
+            return []
+        return mergeTileRuns(self._dirtyTiles, self._xBounds, self._yBounds)
+
+    def reset(self):
+        """ Treat the next frame as entirely changed """
+        self._frameShape = None
+
+    def update(self, frame):
+        """ Compare a frame with the reference and find the dirty tiles """
+        if frame.shape != self._frameShape:
+            self._start(frame)
+            return
+
+        self._shrink(frame)
+        cv2.absdiff(self._smallGray, self._reference, self._difference)
+        numRows, numColumns = self._dirtyTiles.shape
+        cellMaxima = self._difference.reshape(
+            numRows, self.cellSize, numColumns, self.cellSize).max(axis=(1, 3))
+        self._dirtyTiles = cellMaxima > self.threshold
+
+        # Only dirty tiles take on the new frame as their reference
+        dirtyCells = numpy.repeat(numpy.repeat(
+            self._dirtyTiles, self.cellSize, 0), self.cellSize, 1)
+        numpy.copyto(self._reference, self._smallGray, where=dirtyCells)
+
+    def _start(self, frame):
+        height, width = frame.shape[:2]
+        self._frameShape = frame.shape
+        self._xBounds = createTileBounds(width, self.tileSize)
+        self._yBounds = createTileBounds(height, self.tileSize)
+        smallSize = ((len(self._xBounds) - 1) * self.cellSize,
+                     (len(self._yBounds) - 1) * self.cellSize)
+        self._smallGray = numpy.empty(smallSize[::-1], numpy.uint8)
+        self._difference = numpy.empty_like(self._smallGray)
+        self._shrink(frame)
+        self._reference = self._smallGray.copy()
+        self._dirtyTiles = numpy.ones(
+            (len(self._yBounds) - 1, len(self._xBounds) - 1), bool)
+
+    def _shrink(self, frame):
+        size = self._smallGray.shape[::-1]
+        if frame.ndim == 2:
+            cv2.resize(frame, size, self._smallGray,
+                       interpolation=cv2.INTER_AREA)
+        else:
+            cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA),
+                         cv2.COLOR_BGR2GRAY, self._smallGray)
+
+
+class TiledFilterCache(object):
+    """ Applies a filter only to the changed parts of a frame
+
+    The filter's last output is kept. The dirty rectangles are snapped to
+    the same grid of tiles as a MotionGate of the same tileSize, and the
+    dirty tiles merged into runs along rows. apply() recomputes the output
+    around each run, from the input around it padded by the filter's halo,
+    and reuses the kept output everywhere else. The recomputed pixels are
+    identical to those of filtering the whole frame.
+
+    Snapping leaves few region shapes, and each is filtered by a copy of the
+    filter of its own, with a scratch buffer of its own, so filters that keep
+    buffers of the input's shape, such as StrokeEdgesFilter, don't
+    reallocate them. The most recently used maxCachedShapes copies are kept.
+    Call invalidate() whenever the filter's parameters change, which also
+    discards the copies.
+    """
+
+    def __init__(self, filter, halo=None, tileSize=64, maxCachedShapes=32):
+        self.filter = filter
+        self.halo = halo
+        self.tileSize = tileSize
+        self.maxCachedShapes = maxCachedShapes
+
+        self._func = getattr(filter, 'apply', filter)
+        self._output = None
+        self._xBounds = None
+        self._yBounds = None
+        # (filter copy's apply function, scratch buffer) by region shape
+        self._shapeFilters = collections.OrderedDict()
+
+    def invalidate(self):
+        """ Recompute the whole frame on the next apply() """
+        self._output = None
+        self._shapeFilters.clear()
+
+    def apply(self, src, dst, dirtyRects=None):
+        """ Filter the dirty rectangles of src, or all of it if None """
+        if self._output is None or self._output.shape != src.shape or \
+                self._output.dtype != src.dtype or dirtyRects is None:
+            height, width = src.shape[:2]
+            self._xBounds = createTileBounds(width, self.tileSize)
+            self._yBounds = createTileBounds(height, self.tileSize)
+            self._output = numpy.empty_like(src)
+            self._func(src, self._output)
+            dst[...] = self._output
+            return
+
+        halo = self.halo
+        if halo is None:
+            halo = self.filter.halo
+        height, width = src.shape[:2]
+        for runRect in self._snapToTiles(dirtyRects):
+            # Changes reach halo pixels beyond the run, and those outputs
+            # depend on input another halo further out
+            x, y, w, h = expandRect(runRect, halo, width, height)
+            inX, inY, inW, inH = expandRect((x, y, w, h), halo, width, height)
+            srcRegion = src[inY:inY+inH, inX:inX+inW]
+            func, scratch = self._getShapeFilter(srcRegion)
+            func(srcRegion, scratch)
+            self._output[y:y+h, x:x+w] = \
+                scratch[y-inY:y-inY+h, x-inX:x-inX+w]
+        dst[...] = self._output
+
+    def _snapToTiles(self, dirtyRects):
+        """ The runs of tiles that the dirty rectangles touch """
+        xBounds, yBounds = self._xBounds, self._yBounds
+        dirtyTiles = numpy.zeros((len(yBounds) - 1, len(xBounds) - 1), bool)
+        for x, y, w, h in dirtyRects:
+            if w <= 0 or h <= 0:
+                continue
+            # The tiles holding the rectangle's first and last pixels
+            firstRow = numpy.searchsorted(yBounds, y, 'right') - 1
+            lastRow = numpy.searchsorted(yBounds, y + h - 1, 'right') - 1
+            firstColumn = numpy.searchsorted(xBounds, x, 'right') - 1
+            lastColumn = numpy.searchsorted(xBounds, x + w - 1, 'right') - 1
+            dirtyTiles[max(0, firstRow):lastRow + 1,
+                       max(0, firstColumn):lastColumn + 1] = True
+        return mergeTileRuns(dirtyTiles, xBounds, yBounds)
+
+    def _getShapeFilter(self, region):
+        """ Return the filter copy and scratch buffer for region's shape """
+        key = (region.shape, region.dtype.str)
+        shapeFilter = self._shapeFilters.pop(key, None)
+        if shapeFilter is None:
+            filterCopy = copy.deepcopy(self.filter)
+            shapeFilter = (getattr(filterCopy, 'apply', filterCopy),
+                           numpy.empty_like(region))
+            if len(self._shapeFilters) >= self.maxCachedShapes:
+                self._shapeFilters.popitem(last=False)
+        self._shapeFilters[key] = shapeFilter
+        return shapeFilter
@@ -0,0 +1,168 @@
+import concurrent.futures
+import copy
+import multiprocessing
+import numpy
+
+# Only needed by the process-based executor (Python 3.8+)
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def createStripes(height, numStripes):
+    """ Return (top, bottom) row ranges dividing height into numStripes """
+    numStripes = max(1, min(numStripes, height))
+    bounds = numpy.linspace(0, height, numStripes + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def applyToStripe(func, src, dst, top, bottom, halo, scratch=None):
+    """ Apply func to rows [top, bottom) of src, writing them to dst
+
+    The filter sees an extra halo rows above and below the stripe (clipped
+    to the frame), so the rows written are exactly those of a whole-frame
+    call. src and dst must not share memory unless halo is 0.
+    """
+    if halo == 0:
+        func(src[top:bottom], dst[top:bottom])
+        return scratch
+    haloTop = max(0, top - halo)
+    haloBottom = min(src.shape[0], bottom + halo)
+    srcStripe = src[haloTop:haloBottom]
+    if scratch is None or scratch.shape != srcStripe.shape or \
+            scratch.dtype != srcStripe.dtype:
+        scratch = numpy.empty_like(srcStripe)
+    func(srcStripe, scratch)
+    dst[top:bottom] = scratch[top - haloTop:bottom - haloTop]
+    return scratch
+
+
+class StripeExecutor(object):
+    """ Applies a full-frame filter in parallel, one horizontal stripe per task
+
+    The filter is an object with an apply(src, dst) method or a function of
+    the form func(src, dst). Its halo, the number of neighbouring rows each
+    output row depends on, is taken from the filter's halo attribute unless
+    given; for strokeEdges use filters.strokeEdgesHalo(). The output is
+    identical to applying the filter to the whole frame.
+
+    Threads are used by default, since OpenCV releases the GIL. With
+    useProcesses=True the stripes run in a process pool over shared memory
+    frame buffers instead; the filter must then be picklable.
+
+    Each stripe gets its own deep copy of the filter, so filters that keep
+    scratch buffers, such as StrokeEdgesFilter, are never shared between
+    workers and keep buffers of their stripe's size. Changes to the filter
+    after the executor is created are not seen by the copies.
+    """
+
+    def __init__(self, filter, halo=None, numWorkers=None, useProcesses=False):
+        if halo is None:
+            halo = getattr(filter, 'halo', None)
+        assert halo is not None, 'the filter has no halo, so one must be given'
+
+        self.halo = halo
+        self.numWorkers = numWorkers or multiprocessing.cpu_count()
+
+        self._filter = filter
+        self._func = getattr(filter, 'apply', filter)
+        self._useProcesses = useProcesses
+        self._stripeFuncs = {}
+        self._scratches = {}
+        self._srcMemory = None
+        self._dstMemory = None
+
+        if useProcesses:
+            assert shared_memory is not None, \
+                'process-based stripes need multiprocessing.shared_memory'
+            # Workers must share this process's resource tracker, or their
+            # own trackers would unlink the frame buffers when they exit
+            resource_tracker.ensure_running()
+            self._pool = multiprocessing.Pool(
+                self.numWorkers, _initStripeWorker, (self._func,))
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.numWorkers)
+
+    def apply(self, src, dst):
+        """ Apply the filter with a source/destination of any channel count """
+        stripes = createStripes(src.shape[0], self.numWorkers)
+        if self._useProcesses:
+            self._applyInProcesses(src, dst, stripes)
+        else:
+            self._applyInThreads(src, dst, stripes)
+
+    def close(self):
+        """ Shut down the workers and free any shared memory """
+        if self._useProcesses:
+            self._pool.close()
+            self._pool.join()
+            for memory in (self._srcMemory, self._dstMemory):
+                if memory is not None:
+                    memory.close()
+                    memory.unlink()
+            self._srcMemory = None
+            self._dstMemory = None
+        else:
+            self._pool.shutdown()
+
+    def _applyInThreads(self, src, dst, stripes):
+        if self.halo > 0 and numpy.may_share_memory(src, dst):
+            # Stripes would otherwise read halo rows that have been overwritten
+            src = src.copy()
+
+        for index in range(len(stripes)):
+            if index not in self._stripeFuncs:
+                stripeFilter = copy.deepcopy(self._filter)
+                self._stripeFuncs[index] = getattr(
+                    stripeFilter, 'apply', stripeFilter)
+
+        def applyStripe(index):
+            top, bottom = stripes[index]
+            self._scratches[index] = applyToStripe(
+                self._stripeFuncs[index], src, dst, top, bottom, self.halo,
+                self._scratches.get(index))
+
+        list(self._pool.map(applyStripe, range(len(stripes))))
+
+    def _applyInProcesses(self, src, dst, stripes):
+        self._srcMemory = self._ensureMemory(self._srcMemory, src.nbytes)
+        self._dstMemory = self._ensureMemory(self._dstMemory, dst.nbytes)
+        sharedSrc = numpy.ndarray(src.shape, src.dtype, self._srcMemory.buf)
+        sharedDst = numpy.ndarray(dst.shape, dst.dtype, self._dstMemory.buf)
+        sharedSrc[:] = src
+
+        tasks = [(self._srcMemory.name, self._dstMemory.name, src.shape,
+                  src.dtype.str, top, bottom, self.halo)
+                 for top, bottom in stripes]
+        self._pool.map(_applyStripeInWorker, tasks)
+        dst[:] = sharedDst
+
+    def _ensureMemory(self, memory, size):
+        if memory is not None and memory.size >= size:
+            return memory
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+        return shared_memory.SharedMemory(create=True, size=size)
+
+
+# State of each worker process in a process-based StripeExecutor
+_workerFunc = None
+_workerMemories = {}
+
+def _initStripeWorker(func):
+    global _workerFunc
+    _workerFunc = func
+
+def _attachMemory(name):
+    memory = _workerMemories.get(name)
+    if memory is None:
+        memory = shared_memory.SharedMemory(name=name)
+        _workerMemories[name] = memory
+    return memory
+
+def _applyStripeInWorker(task):
+    srcName, dstName, shape, dtype, top, bottom, halo = task
+    src = numpy.ndarray(shape, dtype, _attachMemory(srcName).buf)
+    dst = numpy.ndarray(shape, dtype, _attachMemory(dstName).buf)
+    applyToStripe(_workerFunc, src, dst, top, bottom, halo)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+""" Run the frame loop as a pipeline of stages on their own threads
+
+Each stage (tracking, face swapping, filtering, output) runs on a worker
+thread and hands frames to the next through a bounded queue, so while frame
+N is being filtered frame N+1 can already be tracked. Frames are read into
+a fixed pool of buffers, which bounds memory and applies backpressure to
+the source, and reach the end of the pipeline in capture order.
+
+Usage: python pipeline.py clip.avi [--output out.avi] [--swap-faces]
+           [--queue-size 2] [--max-frames 300] [--sequential] [--show]
+
+The script reports the throughput and each stage's utilization, the share
+of the run it spent working; the busiest stage is the bottleneck. With
+--sequential the same stages run one after another on one thread instead.
+"""
+
+import argparse
+import collections
+import queue
+import threading
+import time
+
+import cv2
+import numpy
+
+import filters
+import framestore
+import rects
+from trackers import FaceTracker
+
+
+class PipelineFrame(object):
+    """ A frame passing through the pipeline, and what stages found in it """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.frame = None
+        self.index = None
+        self.timestamp = None
+        self.data = {}
+
+
+class BufferPool(object):
+    """ A fixed set of PipelineFrames, each with a preallocated frame buffer
+
+    acquire() blocks while every frame is in use.
+    """
+
+    def __init__(self, shape, dtype, numBuffers):
+        self._freeFrames = queue.Queue()
+        for _ in range(numBuffers):
+            self._freeFrames.put(PipelineFrame(numpy.empty(shape, dtype)))
+
+    def acquire(self, timeout=None):
+        try:
+            return self._freeFrames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, pipelineFrame):
+        pipelineFrame.frame = None
+        pipelineFrame.data = {}
+        self._freeFrames.put(pipelineFrame)
+
+
+class StagePipeline(object):
+    """ Runs (name, func) stages concurrently, one thread per stage
+
+    Each func is called as func(pipelineFrame) and works on
+    pipelineFrame.frame in place, leaving anything later stages need in
+    pipelineFrame.data. A stage sees the frames one at a time, in order, so
+    stateful stages such as tracking behave as in a sequential loop.
+
+    The consumer takes finished frames with takeFrame() and hands them back
+    with releaseFrame(), as with managers.AsyncCapture. If a stage or the
+    source raises, reading stops, the frames already past that stage still
+    come out, and then takeFrame() raises the exception.
+    """
+
+    def __init__(self, stages, queueSize=2, numBuffers=None):
+        assert stages, 'a pipeline needs at least one stage'
+        self.stages = list(stages)
+        self.queueSize = queueSize
+        # Enough frames to fill every queue and keep every stage, the
+        # source and the consumer busy
+        self.numBuffers = numBuffers or \
+            (len(self.stages) + 1) * (queueSize + 1) + 1
+
+        self._queues = [queue.Queue(queueSize)
+                        for _ in range(len(self.stages) + 1)]
+        self._pool = None
+        self._threads = []
+        self._isRunning = False
+        self._isFinished = False
+        self._error = None
+
+        self._busyTimes = collections.OrderedDict(
+            (name, 0.0) for name, _ in self.stages)
+        self._busyTimes['read'] = 0.0
+        self._framesRead = 0
+        self._framesTaken = 0
+        self._startTime = None
+        self._endTime = None
+
+    @property
+    def stats(self):
+        """ Frames, fps and each stage's utilization and mean ms per frame """
+        if self._startTime is None:
+            return None
+        wallTime = (self._endTime or time.time()) - self._startTime
+        numFrames = max(1, self._framesRead)
+        stages = collections.OrderedDict()
+        for name, busyTime in self._busyTimes.items():
+            stages[name] = {
+                'utilization': busyTime / max(wallTime, 1e-9),
+                'msPerFrame': 1000.0 * busyTime / numFrames}
+        return {'frames': self._framesTaken,
+                'fps': self._framesTaken / max(wallTime, 1e-9),
+                'stages': stages}
+
+    def start(self, capture, maxFrames=None):
+        """ Start reading frames from a capture and running the stages """
+        assert not self._threads, 'the pipeline has already been started'
+        self._isRunning = True
+        self._startTime = time.time()
+        self._threads.append(threading.Thread(
+            target=self._read, args=(capture, maxFrames)))
+        for i, (name, func) in enumerate(self.stages):
+            self._threads.append(threading.Thread(
+                target=self._runStage, args=(name, func, i)))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def takeFrame(self):
+        """ Return the next finished PipelineFrame, or None at the end """
+        if self._isFinished:
+            return None
+        pipelineFrame = self._queues[-1].get()
+        if pipelineFrame is None:
+            self._isFinished = True
+            self._endTime = time.time()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return None
+        self._framesTaken += 1
+        return pipelineFrame
+
+    def releaseFrame(self, pipelineFrame):
+        """ Return a frame obtained from takeFrame() to the pool """
+        if pipelineFrame is not None:
+            self._pool.release(pipelineFrame)
+
+    def stop(self):
+        """ Stop reading, let the frames in flight through and join
+
+        Raises, once the threads are joined, any exception of a stage that
+        takeFrame() has not raised yet.
+        """
+        self._isRunning = False
+        try:
+            while True:
+                pipelineFrame = self.takeFrame()
+                if pipelineFrame is None:
+                    break
+                self.releaseFrame(pipelineFrame)
+        finally:
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _read(self, capture, maxFrames):
+        try:
+            self._readFrames(capture, maxFrames)
+        except Exception as error:
+            self._fail(error)
+        self._queues[0].put(None)
+
+    def _readFrames(self, capture, maxFrames):
+        index = 0
+        while self._isRunning and (maxFrames is None or index < maxFrames):
+            startTime = time.time()
+            if self._pool is None:
+                # The buffers are sized after the first frame
+                success, frame = capture.read()
+                if success:
+                    self._pool = BufferPool(frame.shape, frame.dtype,
+                                            self.numBuffers)
+                    pipelineFrame = self._pool.acquire()
+                    pipelineFrame.buffer[...] = frame
+                    frame = pipelineFrame.buffer
+            else:
+                # Waiting for a free buffer doesn't count as busy
+                pipelineFrame = self._pool.acquire()
+                startTime = time.time()
+                success, frame = capture.read(pipelineFrame.buffer)
+                if success and frame is not pipelineFrame.buffer:
+                    # Some sources return their own arrays, which may be
+                    # reused by the next read
+                    pipelineFrame.buffer[...] = frame
+                    frame = pipelineFrame.buffer
+                elif not success:
+                    self._pool.release(pipelineFrame)
+            self._busyTimes['read'] += time.time() - startTime
+            if not success:
+                break
+            pipelineFrame.frame = frame
+            pipelineFrame.index = index
+            pipelineFrame.timestamp = time.time()
+            self._framesRead += 1
+            self._queues[0].put(pipelineFrame)
+            index += 1
+
+    def _runStage(self, name, func, i):
+        inputQueue = self._queues[i]
+        outputQueue = self._queues[i + 1]
+        isFailed = False
+        while True:
+            pipelineFrame = inputQueue.get()
+            if pipelineFrame is None:
+                if not isFailed:
+                    outputQueue.put(None)
+                return
+            if isFailed:
+                # Discard the frames still coming, so the source isn't
+                # left waiting for buffers
+                self._pool.release(pipelineFrame)
+                continue
+            startTime = time.time()
+            try:
+                func(pipelineFrame)
+            except Exception as error:
+                self._fail(error)
+                self._pool.release(pipelineFrame)
+                outputQueue.put(None)
+                isFailed = True
+                continue
+            self._busyTimes[name] += time.time() - startTime
+            outputQueue.put(pipelineFrame)
+
+    def _fail(self, error):
+        """ Keep the first exception, for takeFrame(), and stop reading """
+        if self._error is None:
+            self._error = error
+        self._isRunning = False
+
+
+def createCameoStages(shouldSwapFaces=True, shouldBlendFaces=False,
+                      filterChain=None, faceTracker=None):
+    """ Return the (name, func) stages of Cameo's frame loop """
+    if filterChain is None:
+        filterChain = filters.FilterChain([
+            filters.StrokeEdgesFilter(), filters.BGRProviaCurveFilter()])
+    stages = []
+    if shouldSwapFaces:
+        if faceTracker is None:
+            faceTracker = FaceTracker()
+
+        def track(pipelineFrame):
+            faceTracker.update(pipelineFrame.frame)
+            # The tracker moves on to the next frame while this one is
+            # swapped, so keep this frame's rectangles
+            pipelineFrame.data['faceRects'] = \
+                [face.faceRect for face in faceTracker.faces]
+
+        def swap(pipelineFrame):
+            rects.swapRects(pipelineFrame.frame, pipelineFrame.frame,
+                            pipelineFrame.data['faceRects'],
+                            shouldBlend=shouldBlendFaces)
+
+        stages.append(('track', track))
+        stages.append(('swap', swap))
+
+    def filter(pipelineFrame):
+        filterChain.apply(pipelineFrame.frame, pipelineFrame.frame)
+
+    stages.append(('filter', filter))
+    return stages
+
+def createWriteStage(filename, fps, fourcc='MJPG'):
+    """ Return a ('write', func) stage writing each frame to a video file,
+    and a function that closes the file """
+    writers = []
+
+    def write(pipelineFrame):
+        frame = pipelineFrame.frame
+        if not writers:
+            size = (frame.shape[1], frame.shape[0])
+            writers.append(cv2.VideoWriter(
+                filename, cv2.VideoWriter_fourcc(*fourcc), fps, size))
+        writers[0].write(frame)
+
+    def close():
+        for writer in writers:
+            writer.release()
+
+    return ('write', write), close
+
+def runSequentially(capture, stages, maxFrames=None):
+    """ Run the stages one after another per frame; return the stats """
+    busyTimes = collections.OrderedDict((name, 0.0) for name, _ in stages)
+    busyTimes['read'] = 0.0
+    pipelineFrame = PipelineFrame(None)
+    numFrames = 0
+    startTime = time.time()
+    while maxFrames is None or numFrames < maxFrames:
+        stageStartTime = time.time()
+        success, frame = capture.read(pipelineFrame.buffer)
+        busyTimes['read'] += time.time() - stageStartTime
+        if not success:
+            break
+        pipelineFrame.buffer = pipelineFrame.frame = frame
+        pipelineFrame.index = numFrames
+        pipelineFrame.data = {}
+        for name, func in stages:
+            stageStartTime = time.time()
+            func(pipelineFrame)
+            busyTimes[name] += time.time() - stageStartTime
+        numFrames += 1
+    wallTime = time.time() - startTime
+    stages = collections.OrderedDict()
+    for name, busyTime in busyTimes.items():
+        stages[name] = {
+            'utilization': busyTime / max(wallTime, 1e-9),
+            'msPerFrame': 1000.0 * busyTime / max(1, numFrames)}
+    return {'frames': numFrames, 'fps': numFrames / max(wallTime, 1e-9),
+            'stages': stages}
+
+def printStats(stats):
+    print("[PIPELINE] {} frames, {:.1f} frames/s".format(
+        stats['frames'], stats['fps']))
+    bottleneck = max(stats['stages'].items(),
+                     key=lambda item: item[1]['utilization'])[0]
+    for name, stageStats in stats['stages'].items():
+        print("  {:<8} {:5.1f}% busy {:8.2f} ms/frame{}".format(
+            name, 100.0 * stageStats['utilization'],
+            stageStats['msPerFrame'],
+            '  <-- bottleneck' if name == bottleneck else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the Cameo frame loop as a pipeline over a file')
+    parser.add_argument('input', help='a video file or raw frame store')
+    parser.add_argument('--output', help='write the frames to a video file')
+    parser.add_argument('--swap-faces', action='store_true')
+    parser.add_argument('--blend-faces', action='store_true')
+    parser.add_argument('--queue-size', type=int, default=2)
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--sequential', action='store_true',
+                        help='run the stages on one thread, for comparison')
+    parser.add_argument('--show', action='store_true',
+                        help='show the frames in a window as they finish')
+    args = parser.parse_args()
+
+    capture = framestore.openCapture(args.input)
+    stages = createCameoStages(args.swap_faces, args.blend_faces)
+    closeOutput = None
+    if args.output:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        writeStage, closeOutput = createWriteStage(args.output, fps)
+        stages.append(writeStage)
+
+    if args.sequential:
+        stats = runSequentially(capture, stages, args.max_frames)
+    else:
+        pipeline = StagePipeline(stages, args.queue_size)
+        pipeline.start(capture, args.max_frames)
+        while True:
+            pipelineFrame = pipeline.takeFrame()
+            if pipelineFrame is None:
+                break
+            if args.show:
+                cv2.imshow('Pipeline', pipelineFrame.frame)
+                if cv2.waitKey(1) & 0xFF == 27: # escape
+                    pipeline.stop()
+            pipeline.releaseFrame(pipelineFrame)
+        pipeline.stop()
+        stats = pipeline.stats
+
+    if closeOutput is not None:
+        closeOutput()
+    capture.release()
+    printStats(stats)
@@ -0,0 +1,120 @@
+import json
+import time
+
+import cv2
+import numpy
+
+
+class RingBuffer(object):
+    """ The most recent values of a series, kept in a fixed-size array """
+
+    def __init__(self, length):
+        self._values = numpy.zeros(length)
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, len(self._values))
+
+    def append(self, value):
+        self._values[self._count % len(self._values)] = value
+        self._count += 1
+
+    @property
+    def values(self):
+        """ The stored values, oldest first """
+        length = len(self._values)
+        if self._count <= length:
+            return self._values[:self._count]
+        start = self._count % length
+        return numpy.concatenate((self._values[start:], self._values[:start]))
+
+
+class FrameProfiler(object):
+    """ Times the stages of the frame loop and the loop itself
+
+    Each stage's recent durations and the recent frame times are kept in
+    fixed-size ring buffers, from which the rolling FPS and latency
+    percentiles are computed on demand. When disabled, start(), stop() and
+    markFrame() return immediately.
+    """
+
+    STAGES = ('grab', 'retrieve', 'track', 'swap', 'filter', 'show', 'write')
+
+    def __init__(self, historyLength=240, isEnabled=True):
+        self.isEnabled = isEnabled
+
+        self._historyLength = historyLength
+        self._durations = {}
+        self._startTimes = {}
+        self._frameTimes = RingBuffer(historyLength)
+        for stage in self.STAGES:
+            self._durations[stage] = RingBuffer(historyLength)
+
+    def start(self, stage):
+        """ Start timing a stage of the current frame """
+        if self.isEnabled:
+            self._startTimes[stage] = time.time()
+
+    def stop(self, stage):
+        """ Stop timing a stage, adding its duration to its history """
+        if not self.isEnabled:
+            return
+        startTime = self._startTimes.pop(stage, None)
+        if startTime is None:
+            return
+        durations = self._durations.get(stage)
+        if durations is None:
+            durations = RingBuffer(self._historyLength)
+            self._durations[stage] = durations
+        durations.append(time.time() - startTime)
+
+    def markFrame(self):
+        """ Record that a frame has been completed """
+        if self.isEnabled:
+            self._frameTimes.append(time.time())
+
+    @property
+    def fps(self):
+        """ The frame rate over the recent frames, or None """
+        frameTimes = self._frameTimes.values
+        if len(frameTimes) < 2 or frameTimes[-1] <= frameTimes[0]:
+            return None
+        return float((len(frameTimes) - 1) / (frameTimes[-1] - frameTimes[0]))
+
+    def getStats(self):
+        """ Return the rolling FPS and each timed stage's latencies in ms """
+        stats = {'fps': self.fps, 'stages': {}}
+        for stage, durations in self._durations.items():
+            if len(durations) == 0:
+                continue
+            values = 1000.0 * durations.values
+            p50, p95, p99 = numpy.percentile(values, (50, 95, 99))
+            stats['stages'][stage] = {
+                'mean': float(values.mean()), 'p50': float(p50),
+                'p95': float(p95), 'p99': float(p99)}
+        return stats
+
+    def writeStats(self, file):
+        """ Append the current stats to a file as one line of JSON """
+        stats = self.getStats()
+        stats['time'] = time.time()
+        file.write(json.dumps(stats, sort_keys=True) + '\n')
+        file.flush()
+
+    def drawOverlay(self, image):
+        """ Draw the FPS and each stage's median and p95 latency on an image """
+        stats = self.getStats()
+        lines = []
+        if stats['fps'] is not None:
+            lines.append('{:.1f} fps'.format(stats['fps']))
+        for stage in self.STAGES:
+            stageStats = stats['stages'].get(stage)
+            if stageStats is not None:
+                lines.append('{:<8} {:6.2f} {:6.2f} ms'.format(
+                    stage, stageStats['p50'], stageStats['p95']))
+        for i, line in enumerate(lines):
+            origin = (10, 20 + 18 * i)
+            cv2.putText(image, line, origin, cv2.FONT_HERSHEY_PLAIN, 1.0,
+                        (0, 0, 0), 3)
+            cv2.putText(image, line, origin, cv2.FONT_HERSHEY_PLAIN, 1.0,
+                        (255, 255, 255), 1)
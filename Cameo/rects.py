@@ -1,4 +1,6 @@
+import collections
 import cv2
+import numpy
 
 # We will define the face as a heirarchy of rectangles
 # We'll assume that rectangles will be a tuple of form
@@ -22,41 +24,176 @@ def outlineRect(image, rect, color):
     x,y,w,h = rect
     cv2.rectangle(image,(x,y),(x+w,y+h),color)
 
-def copyRect(src, dst, srcRect, dstRect,interpolation=1):
+def intersectionOverUnion(rect0, rect1):
+    """ Return the area of overlap of two rectangles over that of their union """
+
+    x0,y0,w0,h0 = rect0
+    x1,y1,w1,h1 = rect1
+
+    overlapW = min(x0+w0, x1+w1) - max(x0, x1)
+    overlapH = min(y0+h0, y1+h1) - max(y0, y1)
+    if overlapW <= 0 or overlapH <= 0:
+        return 0.0
+
+    overlap = overlapW * overlapH
+    return float(overlap) / (w0*h0 + w1*h1 - overlap)
+
+class RectSwapper(object):
+    """ Copies and swaps sub-rectangles without allocating whole frames
+
+    Resized rectangles are written straight into the destination, so the
+    cost of a swap depends on the rectangles' area rather than the frame's.
+    The one rectangle a swap must set aside is kept in a scratch buffer that
+    is reused from call to call. A swapper must not be shared between
+    threads.
+    """
+
+    def __init__(self, maxCachedMasks=16):
+        self.maxCachedMasks = maxCachedMasks
+
+        self._scratch = None
+        self._masks = collections.OrderedDict()
+
+    def copyRect(self, src, dst, srcRect, dstRect, interpolation=1,
+            shouldBlend=False):
+        """ Copies part of the source to part of the destination
+
+        With shouldBlend, the copy is blended into the destination through a
+        feathered elliptical mask, hiding the rectangle's edges.
+        """
+
+        x0,y0,w0,h0 = srcRect
+        x1,y1,w1,h1 = dstRect
+        srcROI = src[y0:y0+h0, x0:x0+w0]
+        dstROI = dst[y1:y1+h1, x1:x1+w1]
+
+        if shouldBlend:
+            self._blendRect(srcROI, dstROI, interpolation)
+            return
+
+        if (w0,h0) == (w1,h1):
+            # No resize is needed; NumPy copes with overlapping rectangles
+            dstROI[:] = srcROI
+            return
+
+        # Resize the contents of the source sub-rectangle, placing the result in the
+        # destination's sub-rectangle
+        interpolation = interpolations[interpolation]
+        if src is dst:
+            # Sub-rectangles of one frame share memory bounds even when
+            # apart, so only rectangles that overlap need a temporary
+            isOverlapping = intersectionOverUnion(srcRect, dstRect) > 0
+        else:
+            isOverlapping = numpy.may_share_memory(srcROI, dstROI)
+        if isOverlapping:
+            dstROI[:] = cv2.resize(srcROI, (w1,h1), interpolation=interpolation)
+            return
+        try:
+            cv2.resize(srcROI, (w1,h1), dstROI, interpolation=interpolation)
+        except cv2.error:
+            # The destination's memory layout can't be written to directly
+            dstROI[:] = cv2.resize(srcROI, (w1,h1), interpolation=interpolation)
+
+    def swapRects(self, src, dst, rects, interpolation=1, shouldBlend=False):
+        """ Copy the source with two or more sub-rectangles swapped."""
+
+        if dst is not src:
+            dst[:] = src
+
+        numRects = len(rects)
+
+        if numRects < 2:
+            return
+
+        # Copy the contents of the last rectangle into temporary storage
+        x,y,w,h = rects[numRects - 1]
+        temp = self._getScratch(src[y:y+h, x:x+w])
+
+        # Copy the contents of each rectangle into the next
+        i = numRects - 2
+        while i >= 0:
+            self.copyRect(src, dst, rects[i], rects[i+1], interpolation,
+                          shouldBlend)
+            i -= 1
+
+        # Copy the temporary stored area into the first rectangle
+        self.copyRect(temp, dst, (0,0,w,h), rects[0], interpolation,
+                      shouldBlend)
+
+    def getMask(self, w, h):
+        """ Return the (mask, inverse mask) used to blend a w x h rectangle
+
+        The mask is a feathered ellipse filling the rectangle, with weights
+        in [0,256] so that blends need only integer arithmetic. The most
+        recently used masks are cached by size.
+        """
+        masks = self._masks.get((w,h))
+        if masks is not None:
+            self._masks.pop((w,h))
+        else:
+            masks = createFeatheredMask(w, h)
+            if len(self._masks) >= self.maxCachedMasks:
+                self._masks.popitem(last=False)
+        self._masks[(w,h)] = masks
+        return masks
+
+    def _blendRect(self, srcROI, dstROI, interpolation):
+        h, w = dstROI.shape[:2]
+        if srcROI.shape[:2] == (h, w):
+            resizedROI = srcROI.astype(numpy.uint16)
+        else:
+            resizedROI = cv2.resize(srcROI, (w,h),
+                interpolation=interpolations[interpolation]).astype(numpy.uint16)
+        mask, inverseMask = self.getMask(w, h)
+        if resizedROI.ndim == 2:
+            mask = mask[:,:,0]
+            inverseMask = inverseMask[:,:,0]
+
+        # dst = (src * mask + dst * (256 - mask) + 128) / 256, rounded
+        resizedROI *= mask
+        blendedROI = dstROI.astype(numpy.uint16)
+        blendedROI *= inverseMask
+        blendedROI += resizedROI
+        blendedROI += 128
+        blendedROI >>= 8
+        dstROI[:] = blendedROI
+
+    def _getScratch(self, image):
+        """ Return a copy of image in the scratch buffer """
+        if self._scratch is None or self._scratch.size < image.size or \
+                self._scratch.dtype != image.dtype:
+            self._scratch = numpy.empty(image.size, image.dtype)
+        scratch = self._scratch[:image.size].reshape(image.shape)
+        scratch[:] = image
+        return scratch
+
+def createFeatheredMask(w, h, feather=0.2):
+    """ Return (mask, 256 - mask) for an ellipse filling a w x h rectangle
+
+    The masks are uint16 arrays of shape (h, w, 1) with weights in [0,256].
+    The ellipse fades out over feather times the rectangle's half-size.
+    """
+    mask = numpy.zeros((h, w), numpy.float32)
+    center = (w // 2, h // 2)
+    axes = (max(1, int(w / 2 * (1 - feather))), max(1, int(h / 2 * (1 - feather))))
+    cv2.ellipse(mask, center, axes, 0, 0, 360, 256.0, -1)
+    sigma = max(0.5, feather * min(w, h) / 4)
+    cv2.GaussianBlur(mask, (0,0), sigma, mask)
+    mask = numpy.rint(mask).astype(numpy.uint16).reshape(h, w, 1)
+    return mask, 256 - mask
+
+_swapper = RectSwapper()
+
+def copyRect(src, dst, srcRect, dstRect,interpolation=1,shouldBlend=False):
     """ Copies part of the source to part of the destination """
+    _swapper.copyRect(src, dst, srcRect, dstRect, interpolation, shouldBlend)
 
-    global interpolations
+def swapRects(src,dst,rects,interpolation=1,shouldBlend=False):
+    """ Copy the source with two or more sub-rectangles swapped.
 
-    x0,y0,w0,h0 = srcRect
-    x1,y1,w1,h1 = dstRect
-
-    # Resize the contents of the source sub-rectangle, placing the result in the
-    # destination's sub-rectangle
-
-    dst[y1:y1+h1, x1:x1+w1] = cv2.resize(src[y0:y0+h0, x0:x0+w0],(w1,h1), interpolation=interpolations[interpolation])
-
-def swapRects(src,dst,rects,interpolation=1):
-    """ Copy the source with two or more sub-rectangles swapped."""
-
-    global interpolations
-
-    if dst is not src:
-        dst[:] = src
-
-    numRects = len(rects)
-
-    if numRects < 2:
-        return
-
-    # Copy the contents of the last rectangle into temporary storage
-    x,y,w,h = rects[numRects - 1]
-    temp = src[y:y+h, x:x+w].copy()
-
-    # Copy the contents of each rectangle into the next
-    i = numRects - 2
-    while i >= 0:
-        copyRect(src, dst, rects[i], rects[i+1],interpolation)
-        i -= 1
-
-    # Copy the temporary stored area into the first rectangle
-    copyRect(temp, dst, (0,0,w,h), rects[0], interpolation)
+    With shouldBlend, each rectangle is blended in through a feathered
+    elliptical mask instead of being pasted with hard edges. Uses a
+    module-wide RectSwapper, so use a RectSwapper of your own to swap from
+    several threads.
+    """
+    _swapper.swapRects(src, dst, rects, interpolation, shouldBlend)
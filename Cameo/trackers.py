@@ -1,31 +1,129 @@
+import concurrent.futures
 import cv2
+import os
 import rects
+import threading
 import utils
 
 
+CASCADES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'cascades')
+
+
 class Face(object):
     """ Data on facial features: face, eyes, nose, mouth """
 
     def __init__(self):
+        self.id = None
         self.faceRect = None
         self.leftEyeRect = None
         self.rightEyeRect = None
         self.noseRect = None
         self.mouthRect = None
 
+    def translate(self, dx, dy):
+        """ Move the face and each of its features by (dx, dy) """
+        self.faceRect = _translateRect(self.faceRect, dx, dy)
+        self.leftEyeRect = _translateRect(self.leftEyeRect, dx, dy)
+        self.rightEyeRect = _translateRect(self.rightEyeRect, dx, dy)
+        self.noseRect = _translateRect(self.noseRect, dx, dy)
+        self.mouthRect = _translateRect(self.mouthRect, dx, dy)
+
+
+def _resizeByScale(image, scale):
+    """ Return a copy of an image resized by scale """
+    if scale == 1.0:
+        return image.copy()
+    h, w = image.shape[:2]
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    if scale < 1.0:
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return cv2.resize(image, size, interpolation=cv2.INTER_LINEAR)
+
+def _translateRect(rect, dx, dy):
+    if rect is None:
+        return None
+    x,y,w,h = rect
+    return (x+dx, y+dy, w, h)
+
 
 class FaceTracker(object):
-    """ A Tracker for facial features: face, eyes, nose, mouth """
-    def __init__(self,scaleFactor = 1.2, minNeighbours = 2, flags=0):
+    """ A Tracker for facial features: face, eyes, nose, mouth
+
+    Faces are detected every detectionInterval frames. In between, each face
+    is followed by matching its appearance in the previous frame against a
+    window around its previous position, which is far cheaper than running
+    the cascades. A full detection is forced as soon as a match is weaker
+    than minTrackingConfidence. Faces keep their id across frames.
+
+    With shouldDetectInROIs, a detection only searches windows around the
+    faces already known, padded by roiPadding times the face size and for
+    faces of about the same size. Every fullScanInterval-th detection, or
+    when no faces are known, still scans the whole frame for new faces.
+
+    With numFeatureThreads > 0, the eye, nose and mouth searches of all the
+    faces found in a frame run concurrently on a pool of that many threads.
+
+    Whole-frame scans can run on a downscaled frame: detectionWidth is the
+    width to scale to, or 'auto' to scale so that the smallest face sought
+    is AUTO_MIN_FACE_SIZE pixels wide. Faces are mapped back to full
+    resolution. Their features are sought at featureScale, 1.0 being full
+    resolution and more than 1.0 upscaling, which may help with small faces.
+    """
+
+    # Twice the 20x20 window of the frontal face cascade
+    AUTO_MIN_FACE_SIZE = 40
+
+    def __init__(self,scaleFactor = 1.2, minNeighbours = 2, flags=0,
+            detectionInterval = 1, minTrackingConfidence = 0.6,
+            trackingSearchRatio = 0.25, shouldDetectInROIs = False,
+            roiPadding = 0.5, fullScanInterval = 10, numFeatureThreads = 0,
+            detectionWidth = None, featureScale = 1.0):
         self.scaleFactor = scaleFactor
         self.minNeighbours = minNeighbours
         self.flags = flags
+        self.detectionInterval = detectionInterval
+        self.minTrackingConfidence = minTrackingConfidence
+        self.trackingSearchRatio = trackingSearchRatio
+        self.shouldDetectInROIs = shouldDetectInROIs
+        self.roiPadding = roiPadding
+        self.fullScanInterval = fullScanInterval
+        self.detectionWidth = detectionWidth
+        self.featureScale = featureScale
 
         self._faces = []
-        self._faceClassifier = cv2.CascadeClassifier('cascades/haarcascade_frontalface_alt.xml')
-        self._eyeClassifier = cv2.CascadeClassifier('cascades/haarcascade_eye.xml')
-        self._noseClassifier = cv2.CascadeClassifier('cascades/haarcascade_mcs_nose.xml')
-        self._mouthClassifier = cv2.CascadeClassifier('cascades/haarcascade_mcs_mouth.xml')
+        self._featureSearches = []
+        self._nextFaceId = 0
+        self._previousImage = None
+        self._framesSinceDetection = 0
+        self._detectionsSinceFullScan = 0
+        self._isTrackingLost = True
+        # Cascades are slow to load, so each is loaded on first use
+        self._classifierPaths = {
+            'face': os.path.join(CASCADES_DIR, 'haarcascade_frontalface_alt.xml'),
+            'eye': os.path.join(CASCADES_DIR, 'haarcascade_eye.xml'),
+            'nose': os.path.join(CASCADES_DIR, 'haarcascade_mcs_nose.xml'),
+            'mouth': os.path.join(CASCADES_DIR, 'haarcascade_mcs_mouth.xml')}
+        self._classifiers = {}
+
+        # Feature searches may run in a pool, each thread with its own
+        # classifiers since a classifier isn't safe to share between threads
+        self._featurePool = None
+        self._threadClassifiers = threading.local()
+        if numFeatureThreads > 0:
+            self._featurePool = concurrent.futures.ThreadPoolExecutor(
+                numFeatureThreads)
+
+    @property
+    def featureScale(self):
+        return self._featureScale
+
+    @featureScale.setter
+    def featureScale(self, value):
+        if not value > 0:
+            raise ValueError('featureScale must be positive, not {}'.format(
+                value))
+        self._featureScale = float(value)
 
     @property
     def faces(self):
@@ -34,61 +132,237 @@ class FaceTracker(object):
 
     def update(self, image):
         """ Update the tracked facial features """
-        # reset the features list
-        self._faces = []
 
-        # Equalize the variant. This makes the tracker more robust to variations in lighting
         # Create greyscale variant of the image, if it isn't already, to improve performance
-        if utils.isGray(image):
-            image = cv2.equalizeHist(image)
-        else:
+        if not utils.isGray(image):
             image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            cv2.equalizeHist(image,image)
 
-        # Classify the image
+        self._framesSinceDetection += 1
+        if self._shouldDetect(image):
+            self._detectFaces(image)
+            self._framesSinceDetection = 0
+        else:
+            self._trackFaces(image)
+
+        self._previousImage = image
+
+    def _shouldDetect(self, image):
+        return self.detectionInterval <= 1 or \
+            self._isTrackingLost or \
+            self._framesSinceDetection >= self.detectionInterval or \
+            self._previousImage is None or \
+            self._previousImage.shape != image.shape
+
+    def _detectFaces(self, image):
+        previousFaces = self._faces
+        self._faces = []
+        self._featureSearches = []
+        self._isTrackingLost = False
+
+        if self.shouldDetectInROIs and previousFaces and \
+                self._detectionsSinceFullScan + 1 < self.fullScanInterval:
+            self._detectionsSinceFullScan += 1
+            for previousFace in previousFaces:
+                self._detectFacesInROI(image, previousFace.faceRect)
+        else:
+            self._detectionsSinceFullScan = 0
+            self._detectFacesInFrame(image)
+
+        self._runFeatureSearches()
+        self._assignIds(previousFaces)
+
+    def _detectFacesInFrame(self, image):
+        """ Seek faces anywhere in the frame, at the detection scale """
         minSize = utils.widthHeightDividedBy(image,8)
-        faceRects = self._faceClassifier.detectMultiScale(
-            image, self.scaleFactor, self.minNeighbours, self.flags, minSize)
-
-        # If we find viable matches, place them in the faces list
-        if faceRects is not None:
-            for faceRect in faceRects:
-                face = Face()
-                face.faceRect = faceRect
-                # Decompose the target feature
-                x,y,w,h = faceRect
-
-                # Seek an eye in the upper LHS of the face
-                searchRect = (x+w/7,y,w*2/7,h/2)
-                face.leftEyeRect = self._detectOneObject(
-                    self._eyeClassifier, image, searchRect, 64
-                )
-
-                # Seek an eye in the upper RHS of the face
-                searchRect = (x+w*4/7,y,w*2/7,h/2)
-                face.rightEyeRect = self._detectOneObject(
-                    self._eyeClassifier, image, searchRect, 64
-                )
-
-                # Seek a nose in the middle of the face
-                searchRect = (x+w/4,y+h/4,w/2,h/2)
-                face.noseRect = self._detectOneObject(
-                    self._noseClassifier, image, searchRect, 32
-                )
-
-                # Seek a mouth in the lower third of the face
-                searchRect = (x+w/6,y+h*2/3,w*2/3,h/3)
-                face.mouthRect = self._detectOneObject(
-                    self._eyeClassifier, image, searchRect, 16
-                )
-
-                self._faces.append(face)
-
-    def _detectOneObject(self, classifier, image, rect, imageSizeToMinSizeRatio):
+        scale = self._getDetectionScale(image, minSize)
+        detectionImage = _resizeByScale(image, scale)
+
+        # Equalize the variant. This makes the tracker more robust to variations in lighting
+        cv2.equalizeHist(detectionImage, detectionImage)
+
+        # Classify the image
+        faceRects = self._getClassifier('face').detectMultiScale(
+            detectionImage, self.scaleFactor, self.minNeighbours,
+            self.flags, (int(minSize[0]*scale), int(minSize[1]*scale)))
+        if len(faceRects) == 0:
+            return
+
+        # Features are sought at their own scale
+        if self.featureScale == scale:
+            featureImage = detectionImage
+        else:
+            featureImage = _resizeByScale(image, self.featureScale)
+            cv2.equalizeHist(featureImage, featureImage)
+
+        for faceRect in faceRects:
+            # Map the face back to full-resolution coordinates
+            faceRect = tuple(int(round(value / scale)) for value in faceRect)
+            self._addFace(faceRect, featureImage, (0,0), image.shape,
+                          self.featureScale)
+
+    def _getDetectionScale(self, image, minSize):
+        """ The scale at which to seek faces in a whole frame """
+        if self.detectionWidth is None:
+            return 1.0
+        if self.detectionWidth == 'auto':
+            # The smallest face needn't be larger than AUTO_MIN_FACE_SIZE
+            return min(1.0, float(self.AUTO_MIN_FACE_SIZE) / max(1, minSize[0]))
+        return min(1.0, float(self.detectionWidth) / image.shape[1])
+
+    def _detectFacesInROI(self, image, previousRect):
+        """ Seek a face of about the previous face's size near it """
+        x,y,w,h = previousRect
+        imageH, imageW = image.shape[:2]
+        roiX0 = max(0, x - int(w * self.roiPadding))
+        roiY0 = max(0, y - int(h * self.roiPadding))
+        roiX1 = min(imageW, x + w + int(w * self.roiPadding))
+        roiY1 = min(imageH, y + h + int(h * self.roiPadding))
+
+        # The equalized crop is shared by the face and feature searches
+        equalizedROI = cv2.equalizeHist(image[roiY0:roiY1, roiX0:roiX1])
+        minSize = (w*3//4, h*3//4)
+        maxSize = (w*4//3, h*4//3)
+        faceRects = self._getClassifier('face').detectMultiScale(
+            equalizedROI, self.scaleFactor, self.minNeighbours, self.flags,
+            minSize, maxSize)
+        for subX, subY, subW, subH in faceRects:
+            faceRect = (roiX0 + int(subX), roiY0 + int(subY),
+                        int(subW), int(subH))
+            # Padded windows of neighbouring faces may overlap
+            if any(rects.intersectionOverUnion(faceRect, face.faceRect) > 0.5
+                   for face in self._faces):
+                continue
+            self._addFace(faceRect, equalizedROI, (roiX0, roiY0), image.shape)
+
+    def _addFace(self, faceRect, image, origin, frameShape, scale=1.0):
+        """ Add a face, queuing searches for its features in an image whose
+        top left corner is at origin in the frame and which is scaled by
+        scale relative to the frame """
+        face = Face()
+        face.faceRect = tuple(int(value) for value in faceRect)
+        self._queueFeatureSearches(face, image, origin, frameShape, scale)
+        self._faces.append(face)
+
+    def _queueFeatureSearches(self, face, image, origin, frameShape, scale):
+        # Decompose the target feature, in the image's coordinates
+        originX, originY = origin
+        x,y,w,h = face.faceRect
+        x = int((x - originX) * scale)
+        y = int((y - originY) * scale)
+        w = int(w * scale)
+        h = int(h * scale)
+        frameH, frameW = frameShape[:2]
+
+        def queue(featureName, classifierName, searchRect, sizeRatio):
+            minSize = (int(frameW * scale)//sizeRatio,
+                       int(frameH * scale)//sizeRatio)
+            self._featureSearches.append((face, featureName, classifierName,
+                                          image, searchRect, minSize, origin,
+                                          scale))
+
+        # Seek an eye in the upper LHS of the face
+        queue('leftEyeRect', 'eye', (x+w//7,y,w*2//7,h//2), 64)
+
+        # Seek an eye in the upper RHS of the face
+        queue('rightEyeRect', 'eye', (x+w*4//7,y,w*2//7,h//2), 64)
+
+        # Seek a nose in the middle of the face
+        queue('noseRect', 'nose', (x+w//4,y+h//4,w//2,h//2), 32)
+
+        # Seek a mouth in the lower third of the face
+        queue('mouthRect', 'mouth', (x+w//6,y+h*2//3,w*2//3,h//3), 16)
+
+    def _runFeatureSearches(self):
+        """ Run the queued feature searches, in the pool if there is one
+
+        Each search sets its own attribute of its own face, so the results
+        don't depend on the order in which the searches finish.
+        """
+        searches = self._featureSearches
+        self._featureSearches = []
+        if self._featurePool is None:
+            for search in searches:
+                self._runFeatureSearch(search, self._classifiers)
+        else:
+            list(self._featurePool.map(self._runFeatureSearchInThread,
+                                       searches))
+
+    def _runFeatureSearchInThread(self, search):
+        classifiers = getattr(self._threadClassifiers, 'classifiers', None)
+        if classifiers is None:
+            classifiers = {}
+            self._threadClassifiers.classifiers = classifiers
+        self._runFeatureSearch(search, classifiers)
+
+    def _runFeatureSearch(self, search, classifiers):
+        face, featureName, classifierName, image, searchRect, minSize, \
+            origin, scale = search
+        setattr(face, featureName, self._detectOneObject(
+            self._getClassifier(classifierName, classifiers), image,
+            searchRect, minSize, origin, scale))
+
+    def _getClassifier(self, name, classifiers=None):
+        """ Return a cascade from classifiers, loading it on first use """
+        if classifiers is None:
+            classifiers = self._classifiers
+        classifier = classifiers.get(name)
+        if classifier is None:
+            classifier = cv2.CascadeClassifier(self._classifierPaths[name])
+            classifiers[name] = classifier
+        return classifier
+
+    def _assignIds(self, previousFaces):
+        """ Give each face the id of the previous face it overlaps most """
+        unmatchedFaces = list(previousFaces)
+        for face in self._faces:
+            bestOverlap = 0.3
+            bestFace = None
+            for previousFace in unmatchedFaces:
+                overlap = rects.intersectionOverUnion(
+                    face.faceRect, previousFace.faceRect)
+                if overlap > bestOverlap:
+                    bestOverlap = overlap
+                    bestFace = previousFace
+            if bestFace is None:
+                face.id = self._nextFaceId
+                self._nextFaceId += 1
+            else:
+                face.id = bestFace.id
+                unmatchedFaces.remove(bestFace)
+
+    def _trackFaces(self, image):
+        imageH, imageW = image.shape[:2]
+        for face in self._faces:
+            x,y,w,h = face.faceRect
+            padX = max(1, int(w * self.trackingSearchRatio))
+            padY = max(1, int(h * self.trackingSearchRatio))
+            searchX0 = max(0, x - padX)
+            searchY0 = max(0, y - padY)
+            searchX1 = min(imageW, x + w + padX)
+            searchY1 = min(imageH, y + h + padY)
+
+            template = self._previousImage[y:y+h, x:x+w]
+            searchImage = image[searchY0:searchY1, searchX0:searchX1]
+            if template.shape[0] != h or template.shape[1] != w or \
+                    searchImage.shape[0] < h or searchImage.shape[1] < w:
+                # The face has reached the edge of the frame
+                self._isTrackingLost = True
+                continue
+
+            result = cv2.matchTemplate(searchImage, template,
+                                       cv2.TM_CCOEFF_NORMED)
+            _, confidence, _, (matchX, matchY) = cv2.minMaxLoc(result)
+            if confidence < self.minTrackingConfidence:
+                self._isTrackingLost = True
+                continue
+
+            face.translate(searchX0 + matchX - x, searchY0 + matchY - y)
+
+    def _detectOneObject(self, classifier, image, rect, minSize, origin=(0,0),
+            scale=1.0):
 
         x,y,w,h, = rect
 
-        minSize = utils.widthHeightDividedBy(image, imageSizeToMinSizeRatio)
         subImage = image[y:y+h, x:x+w]
         subRects = classifier.detectMultiScale(
             subImage, self.scaleFactor, self.minNeighbours, self.flags, minSize)
@@ -97,7 +371,12 @@ class FaceTracker(object):
             return None
 
         subX, subY, subW, subH = subRects[0]
-        return (x+subX,y+subY,subW,subH)
+        originX, originY = origin
+        if scale != 1.0:
+            return (originX+int(round((x+subX)/scale)),
+                    originY+int(round((y+subY)/scale)),
+                    int(round(subW/scale)), int(round(subH/scale)))
+        return (originX+x+int(subX),originY+y+int(subY),int(subW),int(subH))
 
     def drawDebugRects(self, image):
         """ Draw rectangles around the tracked facial features """
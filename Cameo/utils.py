@@ -1,8 +1,56 @@
 import cv2
+import hashlib
 import numpy
-import scipy.interpolate
+import os
 
 
+class CurveFunc(object):
+    """ A function interpolating control points, which accepts arrays
+
+    The control points double as the key under which lookup arrays of the
+    curve are cached. The interpolator is only built when the curve is first
+    evaluated, so curves whose lookup arrays are cached are never evaluated.
+    """
+
+    def __init__(self, points):
+        self.points = tuple(tuple(point) for point in points)
+        self._interpolator = None
+
+    @property
+    def cacheKey(self):
+        return ('curve', self.points)
+
+    def __call__(self, x):
+        if self._interpolator is None:
+            # scipy is slow to import, so only import it once it's needed
+            import scipy.interpolate
+            xs, ys = zip(*self.points)
+            if len(self.points) < 4:
+                kind = 'linear'
+            else:
+                kind = 'cubic'
+            self._interpolator = scipy.interpolate.interp1d(
+                xs, ys, kind, bounds_error = False)
+        return self._interpolator(x)
+
+class CompositeFunc(object):
+    """ The composite func0(func1(x)) of two functions """
+
+    def __init__(self, func0, func1):
+        self.func0 = func0
+        self.func1 = func1
+
+    @property
+    def cacheKey(self):
+        key0 = getattr(self.func0, 'cacheKey', None)
+        key1 = getattr(self.func1, 'cacheKey', None)
+        if key0 is None or key1 is None:
+            return None
+        return ('composite', key0, key1)
+
+    def __call__(self, x):
+        return self.func0(self.func1(x))
+
 def createCurveFunc(points):
     """ Return a function derived from control points """
     if points is None:
@@ -12,47 +60,143 @@ def createCurveFunc(points):
     if numPoints < 2: # You need at least 2 points!
         return None
 
-    xs, ys = zip(*points)
-    if numPoints < 4:
-        kind = 'linear'
-    else:
-        kind = 'cubic'
+    return CurveFunc(points)
 
-    return scipy.interpolate.interp1d(xs, ys, kind, bounds_error = False)
+def scaleCurvePoints(points, length=256):
+    """ Scale control points given for 8-bit values to values in [0,length-1] """
+    if points is None or length == 256:
+        return points
+    scale = float(length - 1) / 255
+    return [(x * scale, y * scale) for x, y in points]
 
 # Because the previous function may be expensive if performed on each pixel of each frame
-# and there are only a possible 256 values in an 8-bit channel, we can create a lookup table
+# and there are only a possible 256 values in an 8-bit channel, we can create a lookup table.
+# Lookup arrays of curves are cached by control points, length and dtype, in memory and
+# optionally on disk (see loadLookupCache and saveLookupCache).
+
+_lookupArrayCache = {}
+# The names of the cached arrays that the last loaded or saved file holds
+_lookupCacheFileNames = set()
 
-def createLookupArray(func, length=256):
+def _getLookupCacheName(func, length, dtype):
+    key = getattr(func, 'cacheKey', None)
+    if key is None:
+        return None
+    key = repr((key, length, numpy.dtype(dtype).str))
+    return 'lookup_' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def createLookupArray(func, length=256, dtype=float):
     """ return a lookup for whole-number inputs to a function
 
-    The lookup values are clamped to [0,length-1]
+    The lookup values are clamped to [0,length-1], with undefined values
+    (outside the curve's control points) mapped to 0, and converted to dtype.
+    The function is evaluated over all inputs in one call where it accepts
+    arrays.
     """
 
     if func is None:
         return None
-    lookupArray = numpy.empty(length)
 
-    i = 0
-    while i < length:
-        func_i = func(i)
-        lookupArray[i] = min(max(0,func_i),length-1)
-        i += 1
+    cacheName = _getLookupCacheName(func, length, dtype)
+    lookupArray = _lookupArrayCache.get(cacheName)
+    if lookupArray is not None:
+        return lookupArray
+
+    xs = numpy.arange(length)
+    try:
+        ys = numpy.asarray(func(xs), dtype=float)
+        if ys.shape != xs.shape:
+            raise ValueError('func does not map arrays elementwise')
+    except (TypeError, ValueError):
+        ys = numpy.array([func(x) for x in xs], dtype=float)
+    ys[numpy.isnan(ys)] = 0
+    lookupArray = numpy.clip(ys, 0, length - 1).astype(dtype)
+
+    if cacheName is not None:
+        # Cached arrays are shared, so guard them against modification
+        lookupArray.flags.writeable = False
+        _lookupArrayCache[cacheName] = lookupArray
     return lookupArray
 
+def loadLookupCache(filename):
+    """ Add the lookup arrays saved by saveLookupCache to the cache
+
+    Returns False if the file doesn't exist.
+    """
+    if not os.path.exists(filename):
+        return False
+    with numpy.load(filename) as lookupArrays:
+        for cacheName in lookupArrays.files:
+            lookupArray = lookupArrays[cacheName]
+            lookupArray.flags.writeable = False
+            _lookupArrayCache[cacheName] = lookupArray
+            _lookupCacheFileNames.add(cacheName)
+    return True
+
+def saveLookupCache(filename):
+    """ Save every cached lookup array to a .npz file """
+    numpy.savez(filename, **_lookupArrayCache)
+    _lookupCacheFileNames.update(_lookupArrayCache)
+
+def isLookupCacheDirty():
+    """ True if arrays were cached that the loaded or saved file lacks """
+    return not _lookupCacheFileNames.issuperset(_lookupArrayCache)
+
 def applyLookupArray(lookupArray, src, dst):
      """ Map a source to a destination using a lookup """
      if lookupArray is None:
          return None
      dst[:] = lookupArray[src]
 
+def createLookupTable(lookupArrays, length=256):
+    """ Return a compiled 8-bit table of shape (length, 1, channels) for cv2.LUT
+
+    Each lookup array becomes one channel of the table. A lookup array of None
+    becomes the identity so that the channel passes through unchanged.
+    """
+    if length != 256:
+        return None
+    identity = numpy.arange(length)
+    columns = [identity if lookupArray is None else lookupArray
+               for lookupArray in lookupArrays]
+    # Truncate, as assigning the float lookup results to 8-bit channels does
+    table = numpy.array(columns).T.astype(numpy.uint8)
+    return table.reshape(length, 1, len(columns))
+
+def applyLookupTable(lookupTable, src, dst):
+    """ Map a source to a destination in one pass using a compiled table
+
+    The table's channel count must be 1 or match that of the source. The
+    source and destination may be the same array.
+    """
+    if lookupTable is None:
+        return None
+    cv2.LUT(src, lookupTable, dst)
+
+def composeLookupTables(lookupTable0, lookupTable1):
+    """ Return a table equivalent to applying lookupTable0 then lookupTable1
+
+    A single-channel table is broadcast against a multi-channel one.
+    """
+    if lookupTable0 is None:
+        return lookupTable1
+    if lookupTable1 is None:
+        return lookupTable0
+    numChannels = max(lookupTable0.shape[2], lookupTable1.shape[2])
+    if lookupTable0.shape[2] < numChannels:
+        lookupTable0 = numpy.repeat(lookupTable0, numChannels, 2)
+    if lookupTable1.shape[2] < numChannels:
+        lookupTable1 = numpy.repeat(lookupTable1, numChannels, 2)
+    channelIndices = numpy.arange(numChannels)
+    return lookupTable1[lookupTable0, 0, channelIndices]
+
 def createCompositeFunc(func0, func1):
     """ Return a composite of two functions (which take only a single argument each) """
     if func0 is None:
         return func1
     if func1 is None:
         return func0
-    return lambda x: func0(func1(x))
+    return CompositeFunc(func0, func1)
 
 def createFlatView(array):
     """ Return a 1D view of an array of any dimensionality """
@@ -68,4 +212,4 @@ def widthHeightDividedBy(image, divisor):
     """ return an image's dimensions divided by a value """
 
     h, w = image.shape[:2]
-    return (w/divisor, h/divisor)
+    return (w//divisor, h//divisor)